@@ -0,0 +1,194 @@
+import os
+import time
+import uuid
+
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+import jobstore
+
+# Admission control. Uploads and conversions are admitted within limits
+# shared by all web workers (through the job store): the bytes of uploads
+# being received, the number of conversions queued or running, and the
+# number of conversions running at the same time. Requests over a limit
+# are refused right away with 429 (too many conversions from the client)
+# or 503 (server busy) and Retry-After, before the upload is received.
+# Parsing uploads for selection takes a conversion slot too.
+#
+# Conversions of small uploads (up to FAST_LANE_MAX_SIZE) go in a fast
+# lane with its own queue, conversion slots and worker pool, so they are
+# not stuck behind large exports.
+
+UPLOADS = "uploads"
+FAST_LANE = "fast"
+NORMAL_LANE = "normal"
+
+DEFAULT_MAX_INFLIGHT_UPLOAD_BYTES = 512 * 1024 * 1024
+# Conversions running at the same time in the normal lane (one per CPU,
+# like the conversion worker pool of each web worker)
+DEFAULT_MAX_CONCURRENT_CONVERSIONS = min(4, os.cpu_count() or 1)
+# Conversions queued or running in each lane, in total and per client
+DEFAULT_MAX_QUEUED_CONVERSIONS = 32
+DEFAULT_MAX_QUEUED_CONVERSIONS_PER_CLIENT = 4
+DEFAULT_FAST_LANE_MAX_SIZE = 1024 * 1024
+DEFAULT_FAST_LANE_CONVERSIONS = 1
+# Seconds clients are asked to wait before trying again
+DEFAULT_RETRY_AFTER = 10
+
+# Tickets left by web workers or conversions that died expire after this
+TICKET_DURATION = 30 * 60
+
+# Seconds between checks for a free conversion slot, doubled after each
+# check up to the longest interval
+SLOT_POLL_INTERVAL = 0.05
+MAX_SLOT_POLL_INTERVAL = 1.0
+# Seconds a request waits for a conversion slot before it is refused
+DEFAULT_SLOT_TIMEOUT = 15
+
+# Prefix of the counters of refused requests (by limit)
+REJECTED = "admission_rejected_"
+
+
+def _reject(app, limit, error):
+    jobstore.increment(f"{REJECTED}{limit}")
+    error.retry_after = app.config.get('ADMISSION_RETRY_AFTER', DEFAULT_RETRY_AFTER)
+    raise error
+
+
+def release(ticket):
+    """
+    Release an upload or conversion ticket (None is ignored).
+    """
+    if ticket is not None:
+        jobstore.remove_admission(ticket)
+
+
+def admit_upload(app, size):
+    """
+    Admit an upload of the given size (None if not known) while it is
+    received. Returns the ticket to release when it is saved.
+
+    Raises ServiceUnavailable (503) if the bytes of uploads being received
+    by all workers would pass MAX_INFLIGHT_UPLOAD_BYTES.
+    """
+    max_bytes = app.config.get('MAX_INFLIGHT_UPLOAD_BYTES', DEFAULT_MAX_INFLIGHT_UPLOAD_BYTES)
+    if max_bytes is None:
+        return None
+    if size is None:
+        # Compressed and chunked request bodies count as the largest allowed
+        size = app.config.get('MAX_UPLOAD_SIZE') or 0
+
+    ticket = uuid.uuid4().hex
+    if jobstore.add_admission(ticket, UPLOADS, size, TICKET_DURATION, max_size=max_bytes) is not None:
+        _reject(app, "upload_bytes", ServiceUnavailable("Too many uploads in progress, try again later."))
+    return ticket
+
+
+def get_lane(app, size):
+    """
+    Returns the lane for converting an upload of the given size (None if
+    not known), FAST_LANE if it is small.
+    """
+    max_size = app.config.get('FAST_LANE_MAX_SIZE', DEFAULT_FAST_LANE_MAX_SIZE)
+    if max_size is not None and size is not None and size <= max_size:
+        return FAST_LANE
+    return NORMAL_LANE
+
+
+def admit_conversion(app, size, client=None):
+    """
+    Admit a conversion of an upload of the given size (None if not known,
+    like the size of a request body being received) to the queue of its
+    lane.
+
+    Returns the slot to pass to jobqueue.submit(), a dict with the ticket,
+    the lane and the number of conversions that may run in the lane.
+
+    Raises TooManyRequests (429) if the client already has
+    MAX_QUEUED_CONVERSIONS_PER_CLIENT conversions queued or running in the
+    lane, or ServiceUnavailable (503) if MAX_QUEUED_CONVERSIONS are.
+    """
+    lane = get_lane(app, size)
+    if lane == FAST_LANE:
+        max_running = app.config.get('FAST_LANE_CONVERSIONS', DEFAULT_FAST_LANE_CONVERSIONS)
+    else:
+        max_running = app.config.get('MAX_CONCURRENT_CONVERSIONS', DEFAULT_MAX_CONCURRENT_CONVERSIONS)
+
+    ticket = uuid.uuid4().hex
+    limit = jobstore.add_admission(
+        ticket, lane, size or 0, TICKET_DURATION,
+        client=client,
+        max_count=app.config.get('MAX_QUEUED_CONVERSIONS', DEFAULT_MAX_QUEUED_CONVERSIONS),
+        max_client_count=app.config.get(
+            'MAX_QUEUED_CONVERSIONS_PER_CLIENT', DEFAULT_MAX_QUEUED_CONVERSIONS_PER_CLIENT
+        ),
+    )
+    if limit == "client_count":
+        _reject(app, "client_queue", TooManyRequests("Too many conversions in progress, try again later."))
+    if limit is not None:
+        _reject(app, "queue", ServiceUnavailable("The conversion queue is full, try again later."))
+    return {"ticket": ticket, "lane": lane, "max_running": max_running}
+
+
+def readmit_conversion(app, slot, size, client=None):
+    """
+    Move an admitted conversion to the lane for the given size, like the
+    size of an upload once it is decompressed (compressed uploads are
+    admitted by the size of the request body).
+
+    Returns the slot to use, the same slot if the lane is right. Raises
+    like admit_conversion() if the queue of the new lane is full, and the
+    caller still has the old slot to release then.
+    """
+    if get_lane(app, size) == slot["lane"]:
+        return slot
+    new_slot = admit_conversion(app, size, client)
+    release(slot["ticket"])
+    return new_slot
+
+
+def wait_for_slot(slot, timeout=None):
+    """
+    Wait until fewer than the allowed number of conversions are running in
+    the lane of the slot, and mark it as running.
+
+    Returns False if no slot was free within timeout seconds (if set).
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    interval = SLOT_POLL_INTERVAL
+    while not jobstore.start_admission(slot["ticket"], slot["lane"], TICKET_DURATION, slot["max_running"]):
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            interval = min(interval, remaining)
+        time.sleep(interval)
+        interval = min(interval * 2, MAX_SLOT_POLL_INTERVAL)
+    return True
+
+
+def start_in_request(app, slot):
+    """
+    Wait for a conversion slot in a web request, for at most
+    ADMISSION_SLOT_TIMEOUT seconds, so web workers are not held while
+    conversions pile up.
+
+    Raises ServiceUnavailable (503) if no slot was free in time.
+    """
+    timeout = app.config.get('ADMISSION_SLOT_TIMEOUT', DEFAULT_SLOT_TIMEOUT)
+    if not wait_for_slot(slot, timeout):
+        _reject(app, "slot_wait", ServiceUnavailable("Too many conversions running, try again later."))
+
+
+def get_stats():
+    """
+    Returns the uploads and conversions admitted by all workers, and the
+    number of requests refused.
+    """
+    admissions = jobstore.get_admissions()
+    lanes = [admissions.get(lane, {}) for lane in (FAST_LANE, NORMAL_LANE)]
+    return {
+        "inflight_upload_bytes": admissions.get(UPLOADS, {}).get("size", 0),
+        "queued_conversions": sum(lane.get("count", 0) - lane.get("running", 0) for lane in lanes),
+        "running_conversions": sum(lane.get("running", 0) for lane in lanes),
+        "rejected": sum(jobstore.get_counters(REJECTED).values()),
+    }
@@ -0,0 +1,204 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Benchmarks of the conversion hot path on synthetic SARTopo exports. Each
+# benchmark is timed over a number of repeats (best time is reported),
+# and then run once more with tracemalloc to measure peak memory.
+#
+#   python benchmarks/bench.py -n 5000 --save before.json
+#   python benchmarks/bench.py -n 5000 --compare before.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import sartopo
+from sartopo2faks import classify_features, enrich_features
+from generate import generate
+
+# Report benchmarks slower than this (compared to saved results)
+REGRESSION_THRESHOLD = 0.1
+
+
+def measure(run, repeat):
+    """
+    Returns (best time in seconds, peak traced memory in bytes) of run().
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def bench_enrich(data, source_path, features):
+    source_data = sartopo.decode(data)
+    return lambda: enrich_features(source_data)
+
+
+def bench_classify(data, source_path, features):
+    output_folder = tempfile.mkdtemp(prefix="fakspy-bench-")
+
+    def run():
+        # Decoding is part of the command line conversion
+        with contextlib.redirect_stdout(io.StringIO()):
+            classify_features(sartopo.load(source_path), output_folder)
+    return run
+
+
+class WebClient:
+    """
+    Drives the web app through the Flask test client, converting in the
+    request so jobs are timed end to end.
+    """
+
+    def __init__(self):
+        # The app keeps uploads, outputs, cached results and the job store
+        # relative to the working folder, so it runs in a temporary folder.
+        # Jobs kept in memory go there too, not in the tmpfs folder shared
+        # with running instances.
+        folder = tempfile.mkdtemp(prefix="fakspy-bench-")
+        os.chdir(folder)
+        import main
+        app = main.create_app({
+            'CONVERSION_WORKERS': 0,
+            'START_SCHEDULER': False,
+            'MEMORY_STORAGE_FOLDER': os.path.join(folder, "memory"),
+        })
+        app.secret_key = "benchmark"
+        self.client = app.test_client()
+
+    def upload(self, data, action):
+        return self.client.post("/process", data={
+            "action": action,
+            "geojson_file": (io.BytesIO(data), "benchmark.geojson"),
+        }, content_type="multipart/form-data")
+
+    def delete(self, job_id):
+        # Also removes cached results, so the next run converts again
+        self.client.post(f"/job/{job_id}/delete")
+
+
+def get_job_id(response):
+    match = re.search(r'name="job_id" value="([^"]+)"', response.get_data(as_text=True))
+    if match is None:
+        raise RuntimeError(f"Unexpected response ({response.status_code})")
+    return match.group(1)
+
+
+def bench_list(data, source_path, features):
+    web = WebClient()
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            web.delete(get_job_id(web.upload(data, "select")))
+    return run
+
+
+def bench_export(data, source_path, features):
+    web = WebClient()
+    ids = [str(i) for i in range(features)]
+
+    def run():
+        job_id = get_job_id(web.upload(data, "select"))
+        web.client.post("/export", data={
+            "job_id": job_id, "upload_file": "benchmark.geojson", "features": ids,
+        })
+        response = web.client.get(f"/download/{job_id}")
+        if response.status_code != 200:
+            raise RuntimeError(f"Download failed ({response.status_code})")
+        response.close()
+        with contextlib.redirect_stdout(io.StringIO()):
+            web.delete(job_id)
+    return run
+
+
+BENCHMARKS = {
+    "enrich_features": bench_enrich,
+    "classify_features": bench_classify,
+    "list_features": bench_list,
+    "process_export": bench_export,
+}
+
+
+def compare(results, baseline):
+    print()
+    print(f"{'benchmark':20} {'time':>10} {'peak':>10}")
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        time_change = result["seconds"] / before["seconds"] - 1
+        peak_change = result["peak_bytes"] / max(before["peak_bytes"], 1) - 1
+        print(f"{name:20} {time_change:>+10.1%} {peak_change:>+10.1%}")
+        if time_change > REGRESSION_THRESHOLD or peak_change > REGRESSION_THRESHOLD:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the conversion of SARTopo exports.")
+    parser.add_argument("benchmarks", nargs="*",
+                        help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("-n", "--features", type=int, default=2000, help="number of features (default: 2000)")
+    parser.add_argument("--track-points", type=int, default=500, help="average points per track (default: 500)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="timed runs per benchmark (default: 3)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument("--save", metavar="FILE", help="save results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="compare with results saved earlier")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark '{name}'")
+
+    export = generate(args.features, args.track_points, args.seed)
+    features = len(export["features"])
+    data = json.dumps(export, ensure_ascii=False).encode("utf-8")
+    source_path = os.path.join(tempfile.mkdtemp(prefix="fakspy-bench-"), "benchmark.geojson")
+    with open(source_path, "wb") as f:
+        f.write(data)
+    del export
+
+    print(f"{features} features, {len(data) / 1e6:.1f} MB, best of {args.repeat}")
+    print(f"{'benchmark':20} {'seconds':>10} {'features/s':>12} {'MB/s':>8} {'peak MB':>10}")
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        seconds, peak = measure(BENCHMARKS[name](data, source_path, features), args.repeat)
+        results[name] = {
+            "seconds": seconds,
+            "features_per_second": features / seconds,
+            "bytes_per_second": len(data) / seconds,
+            "peak_bytes": peak,
+        }
+        print(f"{name:20} {seconds:>10.3f} {features / seconds:>12.0f} "
+              f"{len(data) / seconds / 1e6:>8.1f} {peak / 1e6:>10.1f}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"features": features, "bytes": len(data), "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare(results, json.load(f)["results"])
+        if regressions:
+            print(f"Slower or larger than before: {', '.join(regressions)}")
+            sys.exit(1)
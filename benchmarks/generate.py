@@ -0,0 +1,153 @@
+import argparse
+import json
+import math
+import os
+import random
+import sys
+
+# Generator of synthetic SARTopo exports for benchmarks. Exports have the
+# folders the converter knows (see rules.json), operational periods,
+# assignments referring to them, markers, areas and long GPS tracks,
+# in roughly the mix seen in real operations.
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rules
+
+OTHER_FOLDERS = ["Annet", "Teiger"]
+OPERATIONAL_PERIODS = ["01 Klargjorte oppdrag", "02 Søkes nå", "03 Ferdig søkt"]
+ASSIGNMENT_STATUSES = ["DRAFT", "PREPARED", "INPROGRESS", "COMPLETED"]
+MARKER_TITLES = ["Oppmøte", "KO", "Bosted", "Funn av sko", "Observasjon", "Hindring"]
+MARKER_SYMBOLS = ["cp", "point", "clue", "binoculars", ""]
+
+# Share of features of each kind (the rest are markers)
+TRACK_SHARE = 0.25
+ASSIGNMENT_SHARE = 0.35
+AREA_SHARE = 0.1
+
+
+class Walk:
+    """
+    Random walk in the mountains of southern Norway, in SARTopo's
+    [lng, lat, elevation, time] coordinate order.
+    """
+
+    def __init__(self, rng, center=(9.5, 61.0), spread=0.5):
+        self.rng = rng
+        self.lng = center[0] + rng.uniform(-spread, spread)
+        self.lat = center[1] + rng.uniform(-spread / 2, spread / 2)
+        self.elevation = rng.uniform(200, 1400)
+        self.time = 1_700_000_000_000 + rng.randrange(86_400_000)
+        self.heading = rng.uniform(0, 2 * math.pi)
+
+    def step(self, meters):
+        self.heading += self.rng.gauss(0, 0.3)
+        self.lng += meters * math.sin(self.heading) / (111_320 * math.cos(math.radians(self.lat)))
+        self.lat += meters * math.cos(self.heading) / 111_320
+        self.elevation += self.rng.gauss(0, 2)
+        self.time += int(meters / 1.2 * 1000)
+        return [round(self.lng, 8), round(self.lat, 8), round(self.elevation, 1), self.time]
+
+    def line(self, points, meters=10, dimensions=2):
+        return [self.step(meters)[:dimensions] for _ in range(points)]
+
+    def ring(self, radius, points=12):
+        # Closed ring around the current position
+        ring = []
+        for i in range(points):
+            angle = 2 * math.pi * i / points
+            r = radius * self.rng.uniform(0.7, 1.3)
+            ring.append([
+                round(self.lng + r * math.sin(angle) / (111_320 * math.cos(math.radians(self.lat))), 8),
+                round(self.lat + r * math.cos(angle) / 111_320, 8),
+            ])
+        return ring + [ring[0]]
+
+
+def feature(feature_id, geometry, properties):
+    return {"id": feature_id, "type": "Feature", "geometry": geometry, "properties": properties}
+
+
+def generate(features=1000, track_points=500, seed=0):
+    """
+    Returns a synthetic SARTopo export (FeatureCollection as dict) with
+    about the given number of features.
+
+    Args:
+        features (int): Number of features besides folders and periods.
+        track_points (int): Average number of points in a track.
+        seed (int): Seed for the random generator (same seed, same export).
+    """
+    rng = random.Random(seed)
+    result = []
+
+    folder_ids = []
+    for i, title in enumerate(list(rules.get_rules().folder_to_sink) + OTHER_FOLDERS):
+        folder_id = f"folder-{i}"
+        folder_ids.append(folder_id)
+        result.append(feature(folder_id, None, {"class": "Folder", "title": title}))
+
+    period_ids = []
+    for i, title in enumerate(OPERATIONAL_PERIODS):
+        period_id = f"period-{i}"
+        period_ids.append(period_id)
+        result.append(feature(period_id, None, {"class": "OperationalPeriod", "title": title}))
+
+    for i in range(features):
+        walk = Walk(rng)
+        kind = rng.random()
+        if kind < TRACK_SHARE:
+            points = max(2, int(rng.gauss(track_points, track_points / 4)))
+            geometry = {"type": "LineString", "coordinates": walk.line(points, dimensions=4)}
+            properties = {
+                "class": "Shape",
+                "title": f"Spor {i}",
+                "folderId": rng.choice(folder_ids),
+                "description": "",
+            }
+        elif kind < TRACK_SHARE + ASSIGNMENT_SHARE:
+            if rng.random() < 0.7:
+                geometry = {"type": "Polygon", "coordinates": [walk.ring(rng.uniform(200, 800))]}
+            else:
+                geometry = {"type": "LineString", "coordinates": walk.line(rng.randrange(5, 60), 25)}
+            properties = {
+                "class": "Assignment",
+                "number": f"{i}",
+                "operationalPeriodId": rng.choice(period_ids),
+                "status": rng.choice(ASSIGNMENT_STATUSES),
+                "folderId": None,
+                "description": "",
+            }
+        elif kind < TRACK_SHARE + ASSIGNMENT_SHARE + AREA_SHARE:
+            geometry = {"type": "Polygon", "coordinates": [walk.ring(rng.uniform(50, 300))]}
+            properties = {
+                "class": "Shape",
+                "title": f"Område {i}",
+                "folderId": rng.choice(folder_ids),
+                "description": "",
+            }
+        else:
+            geometry = {"type": "Point", "coordinates": walk.step(0)[:2]}
+            properties = {
+                "class": "Marker",
+                "title": rng.choice(MARKER_TITLES),
+                "marker-symbol": rng.choice(MARKER_SYMBOLS),
+                "folderId": rng.choice(folder_ids),
+                "description": "",
+            }
+        result.append(feature(f"feature-{i}", geometry, properties))
+
+    return {"type": "FeatureCollection", "features": result}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic SARTopo export.")
+    parser.add_argument("output", help="file to write the export to")
+    parser.add_argument("-n", "--features", type=int, default=1000, help="number of features (default: 1000)")
+    parser.add_argument("--track-points", type=int, default=500, help="average points per track (default: 500)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    args = parser.parse_args()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(generate(args.features, args.track_points, args.seed), f, ensure_ascii=False)
+    print(f"Wrote {args.features} features to {args.output}")
@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Benchmarks of cold start: each command runs in a new Python process,
+# the way web workers and the command line tool are started, and the
+# best and median wall time over a number of runs are reported.
+#
+#   python benchmarks/startup.py --save before.json
+#   python benchmarks/startup.py --compare before.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from generate import generate
+
+# Report commands slower than this (compared to saved results)
+REGRESSION_THRESHOLD = 0.1
+
+# Commands run in a temporary folder, where the web app keeps its files
+COMMANDS = {
+    # Import the app as a WSGI server does, starting the scheduler
+    "web_worker": ["-c", "import wsgi"],
+    # Start the app and answer the first request
+    "web_first_request": ["-c", (
+        "import main; "
+        "main.create_app({'START_SCHEDULER': False}).test_client().get('/')"
+    )],
+    "cli_help": [os.path.join(ROOT, "sartopo2faks.py"), "--help"],
+    "cli_convert": [os.path.join(ROOT, "sartopo2faks.py"), "export.geojson", "output.zip"],
+}
+
+
+def run(command, folder):
+    """
+    Returns the wall time in seconds of running the command in a new process.
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, *command], cwd=folder, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def compare(results, baseline):
+    print()
+    print(f"{'command':20} {'median':>10}")
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        change = result["median_seconds"] / before["median_seconds"] - 1
+        print(f"{name:20} {change:>+10.1%}")
+        if change > REGRESSION_THRESHOLD:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the start up of web workers and the command line tool.")
+    parser.add_argument("commands", nargs="*",
+                        help=f"commands to run: {', '.join(COMMANDS)} (default: all)")
+    parser.add_argument("-r", "--repeat", type=int, default=10, help="runs per command (default: 10)")
+    parser.add_argument("--save", metavar="FILE", help="save results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="compare with results saved earlier")
+    args = parser.parse_args()
+    for name in args.commands:
+        if name not in COMMANDS:
+            parser.error(f"unknown command '{name}'")
+
+    folder = tempfile.mkdtemp(prefix="fakspy-startup-")
+    with open(os.path.join(folder, "export.geojson"), "w", encoding="utf-8") as f:
+        json.dump(generate(50, 50), f, ensure_ascii=False)
+
+    print(f"{'command':20} {'best':>10} {'median':>10}")
+    results = {}
+    for name in args.commands or COMMANDS:
+        # One run first, so all runs find the files in the page cache
+        run(COMMANDS[name], folder)
+        times = [run(COMMANDS[name], folder) for _ in range(args.repeat)]
+        results[name] = {"best_seconds": min(times), "median_seconds": statistics.median(times)}
+        print(f"{name:20} {min(times):>10.3f} {statistics.median(times):>10.3f}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare(results, json.load(f)["results"])
+        if regressions:
+            print(f"Slower than before: {', '.join(regressions)}")
+            sys.exit(1)
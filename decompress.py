@@ -0,0 +1,194 @@
+import gzip
+import os
+import zipfile
+import zlib
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.wsgi import LimitedStream
+
+# Compressed uploads. Files can be uploaded as .geojson.gz or .zip, and
+# request bodies can be sent with 'Content-Encoding: gzip'. Everything is
+# decompressed in chunks while it is read, and reading stops with
+# RequestEntityTooLarge (413) as soon as a size limit is passed, so large
+# or malicious (zip bomb) uploads are rejected before they use memory.
+
+CHUNK_SIZE = 1024 * 1024
+
+# Default limits for the size of request bodies as received (compressed)
+# and of uploaded files after decompression
+DEFAULT_MAX_UPLOAD_SIZE = 100 * 1024 * 1024
+DEFAULT_MAX_DECOMPRESSED_SIZE = 1024 * 1024 * 1024
+
+GEOJSON_EXTENSIONS = (".geojson", ".json")
+
+# Errors raised by corrupt compressed data
+DECOMPRESSION_ERRORS = (OSError, EOFError, zlib.error, zipfile.BadZipFile)
+
+
+def too_large(max_size):
+    return RequestEntityTooLarge(f"Upload is larger than {max_size // (1024 * 1024)} MB when decompressed")
+
+
+def open_upload(stream, filename, max_size):
+    """
+    Returns (reader, filename) for the uploaded GeoJSON file, where reader
+    decompresses .gz and .zip uploads while reading, and filename is the
+    name of the GeoJSON file.
+
+    Zip files must contain exactly one GeoJSON (.geojson or .json) file.
+    """
+    name = filename.lower()
+    if name.endswith(".gz"):
+        return gzip.GzipFile(fileobj=stream, mode="rb"), filename[:-len(".gz")]
+
+    if name.endswith(".zip"):
+        try:
+            archive = zipfile.ZipFile(stream)
+        except DECOMPRESSION_ERRORS:
+            raise BadRequest("Invalid zip file")
+        members = [
+            member for member in archive.infolist()
+            if not member.is_dir() and member.filename.lower().endswith(GEOJSON_EXTENSIONS)
+        ]
+        if len(members) != 1:
+            raise BadRequest("Zip file must contain exactly one GeoJSON file")
+        # Sizes in the zip file can be forged, so they are checked while
+        # reading as well
+        if max_size is not None and members[0].file_size > max_size:
+            raise too_large(max_size)
+        return archive.open(members[0]), os.path.basename(members[0].filename)
+
+    return stream, filename
+
+
+def copy_limited(reader, f, max_size, on_chunk=None):
+    """
+    Copy from reader to the file f in chunks, stopping with
+    RequestEntityTooLarge when more than max_size bytes are read.
+
+    Returns the number of bytes copied.
+    """
+    size = 0
+    try:
+        while True:
+            chunk = reader.read(CHUNK_SIZE)
+            if not chunk:
+                return size
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise too_large(max_size)
+            if on_chunk is not None:
+                on_chunk(chunk)
+            f.write(chunk)
+    except DECOMPRESSION_ERRORS:
+        raise BadRequest("Invalid compressed upload")
+
+
+class CountingInput:
+    """
+    Readable stream counting the bytes of a request body as received, and
+    stopping with RequestEntityTooLarge when more than max_size bytes are
+    read (also for chunked request bodies without Content-Length).
+    """
+
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max_size
+        self.size = 0
+
+    def _count(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise RequestEntityTooLarge(f"Upload is larger than {self.max_size // (1024 * 1024)} MB")
+        return chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while chunk := self.read(CHUNK_SIZE):
+                chunks.append(chunk)
+            return b"".join(chunks)
+        return self._count(self.stream.read(size))
+
+    def readline(self, size=-1):
+        return self._count(self.stream.readline(size))
+
+
+class GzipInput:
+    """
+    Readable stream decompressing a gzip encoded request body.
+    """
+
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max_size
+        self.size = 0
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _decompress(self, size):
+        # Never decompress more than asked for, to bound memory use
+        while True:
+            data = self.decompressor.unconsumed_tail
+            if not data:
+                if self.decompressor.eof:
+                    return b""
+                data = self.stream.read(CHUNK_SIZE)
+                if not data:
+                    return self.decompressor.flush()
+            try:
+                chunk = self.decompressor.decompress(data, size)
+            except zlib.error:
+                raise BadRequest("Invalid gzip encoded request body")
+            if chunk:
+                return chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while chunk := self.read(CHUNK_SIZE):
+                chunks.append(chunk)
+            return b"".join(chunks)
+
+        chunk = self._decompress(size)
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise too_large(self.max_size)
+        return chunk
+
+
+class UploadLimits:
+    """
+    WSGI middleware rejecting request bodies larger than MAX_UPLOAD_SIZE
+    (up front from Content-Length, and while they are received), and
+    decompressing 'Content-Encoding: gzip' request bodies (up to
+    MAX_DECOMPRESSED_SIZE) before they are parsed.
+    """
+
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.config = config
+
+    def __call__(self, environ, start_response):
+        max_upload_size = self.config.get('MAX_UPLOAD_SIZE', DEFAULT_MAX_UPLOAD_SIZE)
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        if max_upload_size is not None and length > max_upload_size:
+            return RequestEntityTooLarge()(environ, start_response)
+        if max_upload_size is not None:
+            environ["wsgi.input"] = CountingInput(environ["wsgi.input"], max_upload_size)
+
+        if environ.get("HTTP_CONTENT_ENCODING", "").strip().lower() == "gzip":
+            stream = environ["wsgi.input"]
+            if length:
+                stream = LimitedStream(stream, length)
+            environ["wsgi.input"] = GzipInput(
+                stream, self.config.get('MAX_DECOMPRESSED_SIZE', DEFAULT_MAX_DECOMPRESSED_SIZE)
+            )
+            # The decompressed length is not known up front
+            environ.pop("CONTENT_LENGTH", None)
+            environ.pop("HTTP_CONTENT_ENCODING", None)
+            environ["wsgi.input_terminated"] = True
+
+        return self.wsgi_app(environ, start_response)
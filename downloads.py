@@ -0,0 +1,106 @@
+import os
+import struct
+import tempfile
+import zipfile
+import zlib
+
+# Single sink files served from the zip of a converted job. A sink file is
+# extracted from the zip the first time it is requested, together with a
+# gzip variant, into a folder next to the zip. The gzip variant reuses the
+# deflate data in the zip as is, so nothing is compressed twice.
+
+SINKS_FOLDER = "sinks"
+GZIP_SUFFIX = ".gz"
+
+
+def get_sinks_folder(zip_path):
+    return os.path.join(os.path.dirname(zip_path), SINKS_FOLDER)
+
+
+def get_etag(info, gzip=False):
+    """
+    Returns a strong ETag for a sink file (or its gzip variant) in the zip,
+    from the checksum and size of its content.
+    """
+    etag = f"{info.CRC:08x}-{info.file_size:x}"
+    return f"{etag}-gzip" if gzip else etag
+
+
+def _read_raw(zip_file, info):
+    # Read the compressed data of the entry without decompressing it
+    zip_file.seek(info.header_offset)
+    header = zip_file.read(30)
+    if header[:4] != b"PK\x03\x04":
+        raise zipfile.BadZipFile(f"Bad local header for {info.filename}")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    zip_file.seek(info.header_offset + 30 + name_length + extra_length)
+    return zip_file.read(info.compress_size)
+
+
+def _gzip(zip_path, info):
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        with open(zip_path, "rb") as f:
+            deflated = _read_raw(f, info)
+    else:
+        with zipfile.ZipFile(zip_path) as zipf:
+            data = zipf.read(info)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(data) + compressor.flush()
+
+    # Gzip member: header (without modification time, so the variant is the
+    # same every time it is extracted), raw deflate data, then CRC and size
+    # of the content
+    header = b"\x1f\x8b\x08\x00" + struct.pack("<I", 0) + b"\x00\xff"
+    trailer = struct.pack("<II", info.CRC, info.file_size & 0xFFFFFFFF)
+    return header + deflated + trailer
+
+
+def _write(path, data):
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def list_sink_files(zip_path):
+    """
+    Returns the names of the sink files in the zip of a job (none if
+    there is no zip).
+    """
+    try:
+        with zipfile.ZipFile(zip_path) as zipf:
+            return zipf.namelist()
+    except (FileNotFoundError, zipfile.BadZipFile):
+        return []
+
+
+def get_sink_file(zip_path, sink_file, gzip=False, on_extract=None):
+    """
+    Returns (path, etag) of the sink file (or its gzip variant) extracted
+    from the zip of a job. When the sink file is extracted, on_extract (if
+    set) is called with the number of bytes written.
+
+    Raises FileNotFoundError if there is no zip, or no such sink file in it.
+    """
+    with zipfile.ZipFile(zip_path) as zipf:
+        try:
+            info = zipf.getinfo(sink_file)
+        except KeyError:
+            raise FileNotFoundError(f"No sink file named {sink_file}")
+
+    folder = get_sinks_folder(zip_path)
+    path = os.path.join(folder, os.path.basename(info.filename))
+    gzip_path = f"{path}{GZIP_SUFFIX}"
+    if not os.path.exists(gzip_path):
+        os.makedirs(folder, exist_ok=True)
+        with zipfile.ZipFile(zip_path) as zipf:
+            data = zipf.read(info)
+        _write(path, data)
+        gzip_data = _gzip(zip_path, info)
+        _write(gzip_path, gzip_data)
+        if on_extract is not None:
+            on_extract(len(data) + len(gzip_data))
+
+    if gzip:
+        return gzip_path, get_etag(info, gzip=True)
+    return path, get_etag(info)
@@ -0,0 +1,481 @@
+import os
+import sys
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict
+
+import msgspec
+
+import jobstore
+import sartopo
+from sartopo2faks import index_features
+
+# Per-job cache of parsed uploads. The first parse of an upload writes a
+# compact sidecar next to it (uploads/job_<id>/cache/) with the byte offset
+# of every feature in the upload and the fields needed to list them. Later
+# requests for the same job read the sidecar and decode only the features
+# they need. Sidecars are removed together with the job folder.
+#
+# The size and last use of every sidecar are recorded in the job store, and
+# sidecars over the disk budget (for all jobs, on disk and in memory) are
+# removed by the scheduler (see evict), never on the request path.
+
+CACHE_FOLDER = "cache"
+# Renamed when the format or contents of the index change, so indexes
+# written before are rebuilt
+INDEX_FILE = "features-2.idx"
+
+# numpy and shapely (through spatial) are imported when first used, so web
+# workers start without them
+
+# Budget for indexes kept in memory (per process) and sidecars kept in job
+# folders (shared by all workers)
+MEMORY_BUDGET = 64 * 1024 * 1024
+DISK_BUDGET = 512 * 1024 * 1024
+
+
+class FeatureEntry(msgspec.Struct, array_like=True):
+    feature_class: str
+    title: str
+    folder_id: str
+    geometry_type: str
+
+
+class FeatureIndex(msgspec.Struct):
+    upload_file: str
+    upload_size: int
+    upload_mtime_ns: int
+    # Interleaved (start, length) pairs as unsigned 64-bit integers
+    offsets: bytes
+    # Folder id to folder title
+    folders: dict[str | int, str | None]
+    entries: list[FeatureEntry]
+    # Bounding box (minLng, minLat, maxLng, maxLat) of each feature as
+    # float64, NaN for features without geometry
+    bounds: bytes = b""
+
+    def span(self, i):
+        """
+        Returns the (start, length) of feature i in the upload file.
+        """
+        if not 0 <= i < len(self.entries):
+            raise IndexError(f"Feature {i} not found in upload")
+        spans = array("Q")
+        spans.frombytes(self.offsets[16 * i:16 * (i + 1)])
+        return spans[0], spans[1]
+
+    def get_bounds(self):
+        """
+        Returns the bounding boxes of all features as an (n, 4) array.
+        """
+        import numpy as np
+
+        return np.frombuffer(self.bounds, dtype=np.float64).reshape(-1, 4)
+
+
+_encoder = msgspec.msgpack.Encoder()
+_decoder = msgspec.msgpack.Decoder(FeatureIndex)
+
+_lock = threading.Lock()
+_memory = OrderedDict()
+_memory_size = 0
+
+# Number of feature listings (and selection columns) kept in memory (per process)
+MAX_LISTINGS = 8
+_listings = OrderedDict()
+_columns = OrderedDict()
+
+
+def _address(buffer):
+    import numpy as np
+
+    return np.frombuffer(buffer, dtype=np.uint8).__array_interface__["data"][0]
+
+
+def build_index(upload_path):
+    """
+    Parse the upload once and return (FeatureIndex, sartopo.FeatureCollection).
+    """
+    import numpy as np
+    import spatial
+
+    stat = os.stat(upload_path)
+    with open(upload_path, "rb") as f:
+        data = f.read()
+
+    raw_features = sartopo.decode_raw(data).features
+    base = _address(data) if data else 0
+
+    features = []
+    entries = []
+    spans = array("Q")
+    for raw in raw_features:
+        # Raw values are views into the upload buffer, so the offset is
+        # the distance between the two buffers
+        start = _address(raw) - base
+        if start < 0 or start + len(raw) > len(data):
+            raise ValueError("Unable to locate feature in upload")
+        spans.append(start)
+        spans.append(len(raw))
+
+        feature = sartopo.decode_feature(raw)
+        features.append(feature)
+
+        properties = feature.properties
+        title = properties.get_title("Unknown")
+        entries.append(FeatureEntry(
+            feature_class=properties.feature_class or "",
+            title=str(title),
+            folder_id=properties.folder_id or "",
+            geometry_type=sartopo.geometry_type(feature.geometry),
+        ))
+
+    index = FeatureIndex(
+        upload_file=os.path.basename(upload_path),
+        upload_size=stat.st_size,
+        upload_mtime_ns=stat.st_mtime_ns,
+        offsets=spans.tobytes(),
+        folders=index_features(features)["folders"],
+        entries=entries,
+        # Compute bounding boxes of all features in one batch
+        bounds=spatial.geometry_bounds(
+            [feature.geometry for feature in features]
+        ).astype(np.float64).tobytes(),
+    )
+    return index, sartopo.FeatureCollection(features=features)
+
+
+def get_index_path(upload_path):
+    return os.path.join(os.path.dirname(upload_path), CACHE_FOLDER, INDEX_FILE)
+
+
+def _is_valid(index, upload_path):
+    try:
+        stat = os.stat(upload_path)
+    except FileNotFoundError:
+        return False
+    return (index.upload_file == os.path.basename(upload_path)
+            and index.upload_size == stat.st_size
+            and index.upload_mtime_ns == stat.st_mtime_ns)
+
+
+def _remember(key, index, size):
+    global _memory_size
+    with _lock:
+        if key in _memory:
+            _memory_size -= _memory.pop(key)[1]
+        if size > MEMORY_BUDGET:
+            return
+        _memory[key] = (index, size)
+        _memory_size += size
+        # Evict least recently used indexes until within budget
+        while _memory_size > MEMORY_BUDGET:
+            _, (_, evicted_size) = _memory.popitem(last=False)
+            _memory_size -= evicted_size
+
+
+def _recall(key):
+    with _lock:
+        entry = _memory.get(key)
+        if entry is None:
+            return None
+        _memory.move_to_end(key)
+        return entry[0]
+
+
+def evict(budget=DISK_BUDGET):
+    """
+    Remove the least recently used sidecars until the sidecars of all jobs
+    are within the budget, from the sizes recorded in the job store.
+
+    Returns the number of sidecars removed.
+    """
+    indexes = jobstore.get_feature_indexes()
+    total = sum(index["size"] for index in indexes)
+    removed = 0
+    for index in indexes:
+        if total <= budget:
+            break
+        try:
+            os.remove(index["path"])
+        except FileNotFoundError:
+            pass
+        jobstore.remove_feature_index(index["path"])
+        total -= index["size"]
+        removed += 1
+    return removed
+
+
+def save_index(upload_path, index):
+    index_path = get_index_path(upload_path)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    data = _encoder.encode(index)
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(index_path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, index_path)
+    _remember(index_path, index, len(data))
+    jobstore.add_feature_index(os.path.abspath(index_path), len(data))
+
+
+def load_index(upload_path):
+    """
+    Returns the cached FeatureIndex for the upload, or None if not cached.
+    """
+    index_path = get_index_path(upload_path)
+    index = _recall(index_path)
+    if index is None:
+        try:
+            with open(index_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # Mark the sidecar as recently used for eviction (and record it
+        # again if the job was moved)
+        jobstore.add_feature_index(os.path.abspath(index_path), len(data))
+        index = _decoder.decode(data)
+        _remember(index_path, index, len(data))
+
+    if not _is_valid(index, upload_path):
+        discard(upload_path)
+        return None
+    return index
+
+
+def discard(upload_path):
+    """
+    Forget any cached index for the upload (memory and disk).
+    """
+    global _memory_size
+    index_path = get_index_path(upload_path)
+    with _lock:
+        if index_path in _memory:
+            _memory_size -= _memory.pop(index_path)[1]
+    try:
+        os.remove(index_path)
+    except FileNotFoundError:
+        pass
+    jobstore.remove_feature_index(os.path.abspath(index_path))
+
+
+def discard_folder(upload_folder):
+    """
+    Forget cached indexes for uploads in the given job folder, which is
+    deleted or moved (the sidecar is recorded again where it is used next).
+    """
+    global _memory_size
+    index_path = os.path.join(upload_folder, CACHE_FOLDER, INDEX_FILE)
+    with _lock:
+        if index_path in _memory:
+            _memory_size -= _memory.pop(index_path)[1]
+    # There are no spatial indexes before spatial is imported
+    spatial = sys.modules.get("spatial")
+    if spatial is not None:
+        spatial.discard_spatial_index(index_path)
+    with _lock:
+        _listings.pop(index_path, None)
+        _columns.pop(index_path, None)
+    jobstore.remove_feature_index(os.path.abspath(index_path))
+
+
+def parse_upload(upload_path):
+    """
+    Parse the upload, leaving a sidecar index for later requests.
+
+    Returns (FeatureIndex, sartopo.FeatureCollection).
+    """
+    index, collection = build_index(upload_path)
+    save_index(upload_path, index)
+    return index, collection
+
+
+def adopt_index(upload_path, index_path):
+    """
+    Use the index at index_path, built from an upload with the same
+    content, as the index of this upload. Returns the index, or None if
+    there is no such index.
+    """
+    try:
+        with open(index_path, "rb") as f:
+            index = _decoder.decode(f.read())
+    except (FileNotFoundError, msgspec.DecodeError):
+        return None
+
+    stat = os.stat(upload_path)
+    if index.upload_size != stat.st_size:
+        return None
+    index = msgspec.structs.replace(
+        index,
+        upload_file=os.path.basename(upload_path),
+        upload_mtime_ns=stat.st_mtime_ns,
+    )
+    save_index(upload_path, index)
+    return index
+
+
+def get_or_build_index(upload_path):
+    """
+    Returns the FeatureIndex for the upload, parsing it if not cached.
+    """
+    index = load_index(upload_path)
+    if index is None:
+        index, _ = parse_upload(upload_path)
+    return index
+
+
+def build_listing(index):
+    """
+    Returns the features with geometry in the index as dicts with 'id',
+    'name', 'folder', 'class', 'type' and 'title', in upload order.
+    """
+    listing = []
+    for i, entry in enumerate(index.entries):
+        if not entry.geometry_type:
+            continue
+        folder_name = str(index.folders.get(entry.folder_id, 'None'))
+        listing.append({
+            'id': i,
+            'name': f"[{folder_name}]"
+                    f"[{entry.feature_class}] "
+                    f"{entry.title}",
+            'folder': folder_name,
+            'class': entry.feature_class,
+            'type': entry.geometry_type,
+            'title': entry.title,
+        })
+    return listing
+
+
+def _get_cached(cache, upload_path, index, build):
+    # Values built from an index are kept until the index changes
+    key = get_index_path(upload_path)
+    with _lock:
+        entry = cache.get(key)
+        if entry is not None and entry[0] is index:
+            cache.move_to_end(key)
+            return entry[1]
+
+    value = build(index)
+    with _lock:
+        cache[key] = (index, value)
+        while len(cache) > MAX_LISTINGS:
+            cache.popitem(last=False)
+    return value
+
+
+def get_listing(upload_path, index):
+    """
+    Returns the (cached) feature listing of the upload, see build_listing().
+    """
+    return _get_cached(_listings, upload_path, index, build_listing)
+
+
+def build_columns(index):
+    """
+    Returns the folder name, class and geometry type of every feature in
+    the index as columns of (values, codes) where values are the distinct
+    values and codes an array with the position of each feature's value.
+    """
+    import numpy as np
+
+    columns = {}
+    for name, values in (
+        ('folder', [str(index.folders.get(entry.folder_id, 'None')) for entry in index.entries]),
+        ('class', [entry.feature_class for entry in index.entries]),
+        ('type', [entry.geometry_type for entry in index.entries]),
+    ):
+        distinct, codes = np.unique(np.array(values, dtype=str), return_inverse=True)
+        columns[name] = (distinct.tolist(), codes)
+    return columns
+
+
+def select_ids(upload_path, index, include=None, exclude=None):
+    """
+    Returns ids of features with geometry matching the rules, in upload order.
+
+    Rules are dicts from column ('folder', 'class' or 'type') to a list of
+    values. Features must have one of the included values in every column
+    given in include, and none of the excluded values in exclude.
+    """
+    import numpy as np
+
+    columns = _get_cached(_columns, upload_path, index, build_columns)
+    values, codes = columns['type']
+    # Only features with geometry can be selected
+    matches = ~np.isin(codes, [i for i, value in enumerate(values) if not value])
+    for rules, wanted in ((include or {}, True), (exclude or {}, False)):
+        for name, rule_values in rules.items():
+            if name not in columns:
+                raise ValueError(f"Unknown selection column '{name}'")
+            values, codes = columns[name]
+            rule_codes = [i for i, value in enumerate(values) if value in set(rule_values)]
+            matches &= np.isin(codes, rule_codes) == wanted
+    return np.flatnonzero(matches).tolist()
+
+
+def parse_ranges(text, count):
+    """
+    Parse feature ids given as ranges like '0-99,105,200-299'. All ids
+    must be less than count (the number of features).
+    """
+    ids = []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        start = int(start)
+        end = int(end) if end else start
+        if start < 0 or end < start or end >= count:
+            raise ValueError(f"Invalid range '{part}'")
+        ids.extend(range(start, end + 1))
+    return ids
+
+
+def filter_listing(listing, folder=None, feature_class=None, geometry_type=None, title=None, query=None):
+    """
+    Returns the features in the listing matching all the given filters.
+
+    Args:
+        folder (str): Folder name.
+        feature_class (str): Feature class (like 'Assignment').
+        geometry_type (list): Geometry types (like 'LineString').
+        title (str): Text the title contains (ignoring case).
+        query (str): Words that all must be in the name (ignoring case).
+    """
+    title = title.lower() if title else None
+    terms = query.lower().split() if query else []
+    return [
+        feature for feature in listing
+        if (folder is None or feature['folder'] == folder)
+        and (feature_class is None or feature['class'] == feature_class)
+        and (geometry_type is None or feature['type'] in geometry_type)
+        and (title is None or title in feature['title'].lower())
+        and all(term in feature['name'].lower() for term in terms)
+    ]
+
+
+def read_features(upload_path, index, ids):
+    """
+    Decode only the features at the given positions in the upload.
+    """
+    features = []
+    with open(upload_path, "rb") as f:
+        for i in ids:
+            start, length = index.span(i)
+            f.seek(start)
+            features.append(sartopo.decode_feature(f.read(length)))
+    return sartopo.FeatureCollection(features=features)
+
+
+def find_intersecting(upload_path, index, geometry):
+    """
+    Returns ids of features in the upload intersecting the shapely geometry.
+    """
+    import spatial
+
+    spatial_index = spatial.get_spatial_index(get_index_path(upload_path), index.get_bounds())
+    return spatial_index.intersecting(
+        geometry, lambda ids: read_features(upload_path, index, ids).features
+    )
@@ -0,0 +1,365 @@
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import traceback
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+import admission
+import featurecache
+import jobstore
+import metrics
+import resultcache
+import sartopo
+from sartopo2faks import (
+    DEFAULT_COMPRESS_LEVEL, enrich_features, reduce_sink_files, sink_file_name, sort_enriched_features,
+    write_sink_zip,
+)
+
+# Conversions are run in a bounded pool of worker processes. The state of
+# each job is written to a small status file in the job's output folder,
+# so any web worker can answer status requests for it.
+#
+# Jobs admitted to the fast lane (see admission.py) run in a pool of their
+# own, so they are not queued behind large jobs.
+
+STATUS_FILE = "status.json"
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+DEFAULT_MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+# Jobs are claimed in the job store while converted, so their files are not
+# moved between storage backends meanwhile (see storage.move_to_disk). The
+# claim expires if the worker dies. Conversions wait for a job being moved.
+CONVERTING = "converting"
+CLAIM_DURATION = 30 * 60
+CLAIM_TIMEOUT = 10
+CLAIM_POLL_INTERVAL = 0.05
+
+_lock = threading.Lock()
+# Worker pool of each lane
+_executors = {}
+# Number of jobs submitted to the pool (by this process) and not yet done
+_pending = 0
+
+
+def get_status_path(output_folder):
+    return os.path.join(output_folder, STATUS_FILE)
+
+
+def write_status(output_folder, state, error=None, **extra):
+    status = {
+        "state": state,
+        "updated": datetime.now().isoformat(),
+        **extra,
+    }
+    if error:
+        status["error"] = error
+
+    # Write to a temporary file first to never expose partial status
+    status_path = get_status_path(output_folder)
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(status_path))
+    with os.fdopen(fd, "w") as f:
+        json.dump(status, f)
+    os.replace(tmp_path, status_path)
+    return status
+
+
+def read_status(output_folder):
+    """
+    Returns the status of the job in the given output folder, or None if
+    no conversion has been submitted for it.
+    """
+    try:
+        with open(get_status_path(output_folder), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def load_selection(upload_path, selected_ids):
+    """
+    Load the selected features (all if selected_ids is None) from the upload.
+    """
+    # Read only the selected features if the upload was indexed when listed
+    index = featurecache.load_index(upload_path) if selected_ids is not None else None
+    if index is not None:
+        return featurecache.read_features(
+            upload_path, index, [int(i) for i in selected_ids]
+        )
+
+    # Decode original GeoJSON data
+    source_data = sartopo.load(upload_path)
+    if selected_ids is not None:
+        source_data.features = [source_data.features[int(i)] for i in selected_ids]
+    return source_data
+
+
+def convert_upload(upload_path, selected_ids, zip_path,
+                   compress_level=DEFAULT_COMPRESS_LEVEL, compact=False, skip_empty=False,
+                   tolerance=None, precision=None, sequence=False):
+    """
+    Convert the selected features of the upload into a zip with FAKS sink files.
+
+    Returns (result, stats) where result has the number of coordinate
+    bytes saved by simplification (saved_bytes, 0 if neither tolerance nor
+    precision is set) and the bounding box of each sink file (sink_bounds,
+    None for sinks without geometries), and stats are measurements for
+    metrics.record_stats().
+    """
+    import spatial
+
+    timings = {}
+    with metrics.timed(timings, "convert_load"):
+        source_data = load_selection(upload_path, selected_ids)
+    with metrics.timed(timings, "convert_enrich"):
+        enriched_data = enrich_features(source_data)
+    with metrics.timed(timings, "convert_classify"):
+        sink_files = sort_enriched_features(enriched_data)
+
+    saved_bytes = 0
+    if tolerance or precision is not None:
+        with metrics.timed(timings, "convert_reduce"):
+            saved_bytes = reduce_sink_files(sink_files, tolerance, precision)
+
+    with metrics.timed(timings, "convert_bounds"):
+        sink_bounds = spatial.sink_bounds(sink_files)
+
+    # Write sink files directly into the zip file, and only expose
+    # the zip file for download when it is complete
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(zip_path))
+    os.close(fd)
+    with metrics.timed(timings, "convert_write"):
+        write_sink_zip(
+            sink_files,
+            tmp_path,
+            compress_level=compress_level,
+            compact=compact,
+            skip_empty=skip_empty,
+            sequence=sequence,
+        )
+    with zipfile.ZipFile(tmp_path) as zipf:
+        sink_bytes = {info.filename: info.file_size for info in zipf.infolist()}
+    os.replace(tmp_path, zip_path)
+
+    result = {
+        "saved_bytes": saved_bytes,
+        # Bounds of the sink files written to the zip
+        "sink_bounds": {
+            sink_file_name(sink_file, sequence): bounds for sink_file, bounds in sink_bounds.items()
+            if sink_file_name(sink_file, sequence) in sink_bytes
+        },
+    }
+    return result, {
+        "timings": timings,
+        "features": len(source_data.features),
+        "sink_bytes": sink_bytes,
+    }
+
+
+def _release(slot):
+    if slot is not None:
+        admission.release(slot["ticket"])
+
+
+def claim_job(job_id, timeout=CLAIM_TIMEOUT):
+    """
+    Claim the files of a job for a conversion, before its folders are
+    looked up. Waits while the job is moved between storage backends.
+
+    Raises RuntimeError if the job is still being moved after timeout
+    seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while not jobstore.claim_job(job_id, CONVERTING, CLAIM_DURATION):
+        if time.monotonic() >= deadline:
+            raise RuntimeError("The job is being moved, try again later")
+        time.sleep(CLAIM_POLL_INTERVAL)
+
+
+def release_job(job_id):
+    """
+    Release the claim of a conversion on the files of a job (None is ignored).
+    """
+    if job_id is not None:
+        jobstore.release_job(job_id, CONVERTING)
+
+
+def _record_size(output_folder, upload_path, zip_path):
+    # The output folder is emptied before a conversion, so the job uses
+    # the bytes of the upload and the zip (sink files are added when
+    # extracted)
+    job_id = os.path.basename(output_folder).removeprefix("job_")
+    try:
+        size = os.path.getsize(upload_path) + os.path.getsize(zip_path)
+    except FileNotFoundError:
+        return
+    jobstore.update_job_storage(job_id, size=size)
+
+
+def run_job(output_folder, upload_path, selected_ids, zip_path, options, cache_key=None, slot=None,
+            claim=None):
+    """
+    Run a conversion job and record its state (runs in a worker process).
+
+    With an admission slot, the job stays queued until a conversion slot
+    in its lane is free. A claim on the job (see claim_job) is released
+    when the job is done.
+    """
+    try:
+        try:
+            if slot is not None:
+                admission.wait_for_slot(slot)
+            write_status(output_folder, RUNNING)
+            result, stats = convert_upload(upload_path, selected_ids, zip_path, **options)
+        except Exception as e:
+            traceback.print_exc()
+            return write_status(output_folder, FAILED, str(e))
+        finally:
+            _release(slot)
+
+        _record_size(output_folder, upload_path, zip_path)
+        try:
+            # Share the result with later uploads of the same content
+            resultcache.store_result(cache_key, zip_path, result)
+        except OSError:
+            traceback.print_exc()
+        return write_status(output_folder, DONE, **result, stats=stats)
+    finally:
+        release_job(claim)
+
+
+def queue_depth():
+    """
+    Returns the number of jobs submitted by this process that are queued
+    or running.
+    """
+    return _pending
+
+
+def _job_done(job_id, status, slow_job_seconds):
+    # Record measurements returned by a finished job
+    stats = status.get("stats")
+    if stats:
+        metrics.record_stats(stats)
+        metrics.log_if_slow("job", job_id, stats["timings"], slow_job_seconds,
+                            features=stats["features"])
+
+
+def _init_worker(job_store_file, cache_folder):
+    # Workers use the job store and result cache of the web app
+    jobstore.configure(job_store_file)
+    resultcache.configure(cache_folder)
+
+
+def get_executor(max_workers=DEFAULT_MAX_WORKERS, lane=None):
+    with _lock:
+        executor = _executors.get(lane)
+        if executor is None:
+            # Workers are not forked from the web process, which runs threads
+            # (the scheduler and request handlers) that may hold locks. They
+            # are forked from a server process that has only imported this
+            # module (and not the web app), which keeps worker start cheap.
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context("spawn")
+            executor = _executors[lane] = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(jobstore.get_path(), resultcache.get_folder()),
+            )
+        return executor
+
+
+def reset_executor(lane=None):
+    with _lock:
+        executor = _executors.pop(lane, None)
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def submit(output_folder, upload_path, selected_ids, zip_path, options, max_workers=DEFAULT_MAX_WORKERS,
+           cache_key=None, slow_job_seconds=None, slot=None, claim=None):
+    """
+    Queue a conversion job. With max_workers set to 0 the job is run
+    immediately in the calling process instead.
+
+    The job runs in the pool of the lane of its admission slot (see
+    admission.admit_conversion), which is released when the job is done,
+    like the claim on its files (the job id, see claim_job) if given.
+    If a result for the cache key is cached, it is used right away instead.
+    """
+    try:
+        cached = resultcache.fetch_result(cache_key, zip_path)
+        if cached is not None:
+            _record_size(output_folder, upload_path, zip_path)
+    except Exception:
+        _release(slot)
+        release_job(claim)
+        raise
+    if cached is not None:
+        try:
+            return write_status(output_folder, DONE, cached=True, **cached)
+        finally:
+            _release(slot)
+            release_job(claim)
+
+    status = write_status(output_folder, QUEUED)
+    if selected_ids is not None:
+        selected_ids = [int(i) for i in selected_ids]
+    args = (output_folder, upload_path, selected_ids, zip_path, options, cache_key, slot, claim)
+    job_id = os.path.basename(output_folder).removeprefix("job_")
+    if max_workers == 0:
+        status = run_job(*args)
+        _job_done(job_id, status, slow_job_seconds)
+        return status
+
+    lane = None if slot is None else slot["lane"]
+    if lane == admission.FAST_LANE:
+        max_workers = min(max_workers, slot["max_running"])
+    try:
+        try:
+            future = get_executor(max_workers, lane).submit(run_job, *args)
+        except BrokenProcessPool:
+            # A worker died and took the pool down with it, start a new pool
+            reset_executor(lane)
+            future = get_executor(max_workers, lane).submit(run_job, *args)
+    except Exception:
+        _release(slot)
+        release_job(claim)
+        raise
+
+    global _pending
+    with _lock:
+        _pending += 1
+
+    def on_done(f):
+        global _pending
+        with _lock:
+            _pending -= 1
+        # Record failures that happen outside of run_job (e.g. a worker that died)
+        if f.exception() is not None:
+            _release(slot)
+            release_job(claim)
+            try:
+                write_status(output_folder, FAILED, str(f.exception()))
+            except OSError:
+                # Job was deleted while converting
+                pass
+        else:
+            _job_done(job_id, f.result(), slow_job_seconds)
+
+    future.add_done_callback(on_done)
+    return status
@@ -0,0 +1,540 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Job store backed by SQLite. Jobs are looked up by id and expiry time
+# through indexes, and every update is a single transaction, so the cost
+# of an upload does not grow with the number of jobs and concurrent web
+# workers can't overwrite each other's changes.
+
+# Default file of the job store (JOB_STORE_FILE in the app config)
+DEFAULT_JOB_STORE_FILE = "jobs.sqlite3"
+
+# Legacy JSON files migrated into the store on first use
+LEGACY_GENERATED_JOBS_FILE = "generated_jobs.json"
+LEGACY_SCHEDULED_JOBS_FILE = "scheduled_jobs.json"
+
+# Maximum number of jobs returned by a query
+MAX_LIMIT = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generated_jobs (
+    job_id TEXT PRIMARY KEY,
+    upload_file TEXT NOT NULL,
+    create_time TEXT NOT NULL,
+    delete_time TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS generated_jobs_create_time ON generated_jobs (create_time);
+CREATE INDEX IF NOT EXISTS generated_jobs_delete_time ON generated_jobs (delete_time);
+CREATE TABLE IF NOT EXISTS scheduled_jobs (
+    job_id TEXT PRIMARY KEY,
+    delete_time TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scheduled_jobs_delete_time ON scheduled_jobs (delete_time);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_storage (
+    job_id TEXT PRIMARY KEY,
+    backend TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_storage_accessed ON job_storage (backend, accessed);
+CREATE TABLE IF NOT EXISTS feature_indexes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS feature_indexes_accessed ON feature_indexes (accessed);
+CREATE TABLE IF NOT EXISTS admissions (
+    ticket TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    client TEXT,
+    size INTEGER NOT NULL,
+    running INTEGER NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS admissions_kind ON admissions (kind, running);
+"""
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized = set()
+_job_store_file = DEFAULT_JOB_STORE_FILE
+
+
+def configure(path):
+    """
+    Keep the job store in the given file (made absolute, so it does not
+    move with the working folder).
+    """
+    global _job_store_file
+    _job_store_file = os.path.abspath(path)
+
+
+def get_path():
+    return _job_store_file
+
+
+def to_iso(time):
+    # Fixed width timestamps compare correctly as strings
+    return time.isoformat(timespec="microseconds")
+
+
+def _connect(path=None):
+    path = path or _job_store_file
+    # Connections are kept per thread and never shared with forked processes
+    key = (os.getpid(), path)
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    connection = connections.get(key)
+    if connection is None:
+        connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connections[key] = connection
+        _initialize(connection, path)
+    return connection
+
+
+def _initialize(connection, path):
+    with _init_lock:
+        if path in _initialized:
+            return
+        connection.executescript(SCHEMA)
+        _migrate_legacy_files(connection)
+        _initialized.add(path)
+
+
+def _migrate_legacy_files(connection):
+    # Import jobs from the JSON files used before the job store existed
+    generated = _read_legacy_file(LEGACY_GENERATED_JOBS_FILE)
+    scheduled = _read_legacy_file(LEGACY_SCHEDULED_JOBS_FILE)
+    if generated is None and scheduled is None:
+        return
+
+    with _transaction(connection):
+        connection.executemany(
+            "INSERT OR IGNORE INTO generated_jobs VALUES (?, ?, ?, ?)",
+            [
+                (job_id, job.get("upload_file", ""), job.get("create_time", ""), job.get("delete_time", ""))
+                for job_id, job in (generated or {}).items()
+            ],
+        )
+        connection.executemany(
+            "INSERT OR IGNORE INTO scheduled_jobs VALUES (?, ?)",
+            [(job_id, delete_time) for job_id, delete_time in (scheduled or {}).items()],
+        )
+
+    for file_path in (LEGACY_GENERATED_JOBS_FILE, LEGACY_SCHEDULED_JOBS_FILE):
+        try:
+            os.replace(file_path, f"{file_path}.migrated")
+        except FileNotFoundError:
+            # Not present or already migrated by another worker
+            pass
+
+
+def _read_legacy_file(file_path):
+    if not os.path.exists(file_path):
+        return None
+    try:
+        with open(file_path, "r") as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return {}
+
+
+class _transaction:
+    # Runs the block in an immediate (write locked) transaction
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def add_job(job_id, upload_file, create_time, delete_time):
+    """
+    Record a generated job and schedule it for deletion (atomically).
+    """
+    connection = _connect()
+    with _transaction(connection):
+        connection.execute(
+            "INSERT OR REPLACE INTO generated_jobs VALUES (?, ?, ?, ?)",
+            (job_id, upload_file, to_iso(create_time), to_iso(delete_time)),
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO scheduled_jobs VALUES (?, ?)",
+            (job_id, to_iso(delete_time)),
+        )
+
+
+def unschedule_job(job_id):
+    _connect().execute("DELETE FROM scheduled_jobs WHERE job_id = ?", (job_id,))
+
+
+def unschedule_jobs(job_ids):
+    connection = _connect()
+    with _transaction(connection):
+        connection.executemany(
+            "DELETE FROM scheduled_jobs WHERE job_id = ?",
+            [(job_id,) for job_id in job_ids],
+        )
+
+
+def get_expired_jobs(now, limit=MAX_LIMIT):
+    """
+    Returns ids of jobs scheduled for deletion at or before now, first to
+    expire first (read from the expiry index).
+    """
+    rows = _connect().execute(
+        "SELECT job_id FROM scheduled_jobs WHERE delete_time <= ? ORDER BY delete_time LIMIT ?",
+        (to_iso(now), limit),
+    ).fetchall()
+    return [row["job_id"] for row in rows]
+
+
+def _page(limit, offset):
+    limit = MAX_LIMIT if limit is None else max(0, min(int(limit), MAX_LIMIT))
+    offset = max(0, int(offset or 0))
+    return limit, offset
+
+
+def query_generated_jobs(limit=None, offset=0, upload_file=None, created_after=None, created_before=None):
+    """
+    Returns (total, jobs) for generated jobs matching the filters, newest first.
+
+    Args:
+        limit (int): Maximum number of jobs to return (at most MAX_LIMIT).
+        offset (int): Number of matching jobs to skip.
+        upload_file (str): Only jobs with upload file names containing this.
+        created_after (datetime): Only jobs created at or after this time.
+        created_before (datetime): Only jobs created before this time.
+    """
+    limit, offset = _page(limit, offset)
+    where = []
+    params = []
+    if upload_file:
+        where.append("instr(upload_file, ?) > 0")
+        params.append(upload_file)
+    if created_after:
+        where.append("create_time >= ?")
+        params.append(to_iso(created_after))
+    if created_before:
+        where.append("create_time < ?")
+        params.append(to_iso(created_before))
+    condition = f"WHERE {' AND '.join(where)}" if where else ""
+
+    connection = _connect()
+    total = connection.execute(
+        f"SELECT COUNT(*) FROM generated_jobs {condition}", params
+    ).fetchone()[0]
+    rows = connection.execute(
+        f"SELECT * FROM generated_jobs {condition} ORDER BY create_time DESC LIMIT ? OFFSET ?",
+        params + [limit, offset],
+    ).fetchall()
+    return total, [dict(row) for row in rows]
+
+
+def query_scheduled_jobs(limit=None, offset=0, expires_after=None, expires_before=None):
+    """
+    Returns (total, jobs) for jobs scheduled for deletion, first to expire first.
+    """
+    limit, offset = _page(limit, offset)
+    where = []
+    params = []
+    if expires_after:
+        where.append("delete_time >= ?")
+        params.append(to_iso(expires_after))
+    if expires_before:
+        where.append("delete_time < ?")
+        params.append(to_iso(expires_before))
+    condition = f"WHERE {' AND '.join(where)}" if where else ""
+
+    connection = _connect()
+    total = connection.execute(
+        f"SELECT COUNT(*) FROM scheduled_jobs {condition}", params
+    ).fetchone()[0]
+    rows = connection.execute(
+        f"SELECT * FROM scheduled_jobs {condition} ORDER BY delete_time LIMIT ? OFFSET ?",
+        params + [limit, offset],
+    ).fetchall()
+    return total, [dict(row) for row in rows]
+
+
+def clear_generated_jobs():
+    """
+    Forget all generated jobs. Returns the number of jobs removed.
+    """
+    return _connect().execute("DELETE FROM generated_jobs").rowcount
+
+
+def acquire_lease(name, holder, duration):
+    """
+    Acquire or renew the named lease for the holder. The lease is granted
+    if it is free, expired or already held by the holder, and then lasts
+    for duration seconds.
+
+    Returns True if the holder has the lease.
+    """
+    now = time.time()
+    connection = _connect()
+    with _transaction(connection):
+        connection.execute(
+            "INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE"
+            " SET holder = excluded.holder, expires = excluded.expires"
+            " WHERE leases.holder = excluded.holder OR leases.expires < ?",
+            (name, holder, now + duration, now),
+        )
+        row = connection.execute(
+            "SELECT holder FROM leases WHERE name = ?", (name,)
+        ).fetchone()
+    return row["holder"] == holder
+
+
+def release_lease(name, holder):
+    """
+    Give up the named lease if held by the holder, so another holder can
+    take over without waiting for it to expire.
+    """
+    _connect().execute(
+        "DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder)
+    )
+
+
+def increment(name, amount=1):
+    """
+    Add amount to the named counter (shared by all workers).
+    """
+    _connect().execute(
+        "INSERT INTO counters VALUES (?, ?) ON CONFLICT (name) DO UPDATE"
+        " SET value = value + excluded.value",
+        (name, amount),
+    )
+
+
+def get_counters(prefix=""):
+    """
+    Returns a dict with the value of all counters starting with prefix.
+    """
+    rows = _connect().execute(
+        "SELECT name, value FROM counters WHERE substr(name, 1, ?) = ?",
+        (len(prefix), prefix),
+    ).fetchall()
+    return {row["name"]: row["value"] for row in rows}
+
+
+def add_job_storage(job_id, backend, size, budget=None):
+    """
+    Record the storage backend of a job and the bytes it is expected to
+    use. With a budget, the job is only added if the total size of jobs in
+    the backend stays within it.
+
+    Returns True if the job was added.
+    """
+    connection = _connect()
+    with _transaction(connection):
+        if budget is not None:
+            used = connection.execute(
+                "SELECT COALESCE(SUM(size), 0) AS used FROM job_storage WHERE backend = ?", (backend,)
+            ).fetchone()["used"]
+            if used + size > budget:
+                return False
+        connection.execute(
+            "INSERT OR REPLACE INTO job_storage VALUES (?, ?, ?, ?)",
+            (job_id, backend, size, time.time()),
+        )
+    return True
+
+
+def update_job_storage(job_id, backend=None, size=None, accessed=None):
+    """
+    Change the backend, size and/or last access time of a job.
+    """
+    fields = {"backend": backend, "size": size, "accessed": accessed}
+    fields = {name: value for name, value in fields.items() if value is not None}
+    if fields:
+        _connect().execute(
+            f"UPDATE job_storage SET {', '.join(f'{name} = ?' for name in fields)} WHERE job_id = ?",
+            (*fields.values(), job_id),
+        )
+
+
+def add_job_size(job_id, size):
+    """
+    Add bytes written for a job (like sink files extracted from its zip).
+    """
+    _connect().execute("UPDATE job_storage SET size = size + ? WHERE job_id = ?", (size, job_id))
+
+
+def claim_job(job_id, claim, duration):
+    """
+    Claim the files of a job for a change (like a conversion or a move
+    between storage backends) for duration seconds. The job is claimed if
+    it is not claimed for another change, in one step.
+
+    Returns True if the job is claimed.
+    """
+    return acquire_lease(f"job:{job_id}", claim, duration)
+
+
+def release_job(job_id, claim):
+    release_lease(f"job:{job_id}", claim)
+
+
+def remove_job_storage(job_id):
+    _connect().execute("DELETE FROM job_storage WHERE job_id = ?", (job_id,))
+
+
+def get_job_files(job_id):
+    """
+    Returns the upload file and storage backend of a job as a dict, or
+    None if the job is not known. The backend is None for jobs stored
+    before backends were recorded.
+    """
+    row = _connect().execute(
+        "SELECT generated_jobs.job_id, upload_file, backend, size, accessed FROM generated_jobs"
+        " LEFT JOIN job_storage ON job_storage.job_id = generated_jobs.job_id"
+        " WHERE generated_jobs.job_id = ?",
+        (job_id,),
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def get_job_backend(job_id):
+    row = _connect().execute(
+        "SELECT backend FROM job_storage WHERE job_id = ?", (job_id,)
+    ).fetchone()
+    return row["backend"] if row else None
+
+
+def get_storage_jobs(backend):
+    """
+    Returns the jobs in a backend as dicts with job_id, size and accessed,
+    least recently used first.
+    """
+    rows = _connect().execute(
+        "SELECT job_id, size, accessed FROM job_storage WHERE backend = ? ORDER BY accessed",
+        (backend,),
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def add_feature_index(path, size):
+    """
+    Record the size of a feature index sidecar, and mark it as used now.
+    """
+    _connect().execute(
+        "INSERT OR REPLACE INTO feature_indexes VALUES (?, ?, ?)", (path, size, time.time())
+    )
+
+
+def remove_feature_index(path):
+    _connect().execute("DELETE FROM feature_indexes WHERE path = ?", (path,))
+
+
+def get_feature_indexes():
+    """
+    Returns the feature index sidecars as dicts with path, size and
+    accessed, least recently used first.
+    """
+    rows = _connect().execute(
+        "SELECT path, size, accessed FROM feature_indexes ORDER BY accessed"
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def _remove_expired_admissions(connection, now):
+    connection.execute("DELETE FROM admissions WHERE expires < ?", (now,))
+
+
+def add_admission(ticket, kind, size, duration, client=None, max_count=None, max_client_count=None,
+                  max_size=None):
+    """
+    Admit a ticket of the given kind (like uploads being received, or
+    conversions in a lane) for duration seconds, unless the number of
+    tickets of the kind, of the kind from the client, or their total size
+    would pass the given limits.
+
+    Returns None if the ticket was added, or else the name of the limit
+    ('count', 'client_count' or 'size') that would be passed.
+    """
+    now = time.time()
+    connection = _connect()
+    with _transaction(connection):
+        _remove_expired_admissions(connection, now)
+        row = connection.execute(
+            "SELECT COUNT(*) AS count, COALESCE(SUM(size), 0) AS size,"
+            " COALESCE(SUM(client = ?), 0) AS client_count FROM admissions WHERE kind = ?",
+            (client, kind),
+        ).fetchone()
+        if max_count is not None and row["count"] >= max_count:
+            return "count"
+        if max_client_count is not None and client is not None and row["client_count"] >= max_client_count:
+            return "client_count"
+        # A single ticket larger than the limit is admitted when there are no others
+        if max_size is not None and row["count"] and row["size"] + size > max_size:
+            return "size"
+        connection.execute(
+            "INSERT OR REPLACE INTO admissions VALUES (?, ?, ?, ?, 0, ?)",
+            (ticket, kind, client, size, now + duration),
+        )
+    return None
+
+
+def start_admission(ticket, kind, duration, max_running):
+    """
+    Mark an admitted ticket as running for duration seconds, if fewer than
+    max_running tickets of the kind are running. Tickets that expired while
+    waiting are added again.
+
+    Returns True if the ticket is running.
+    """
+    now = time.time()
+    connection = _connect()
+    with _transaction(connection):
+        _remove_expired_admissions(connection, now)
+        running = connection.execute(
+            "SELECT COUNT(*) FROM admissions WHERE kind = ? AND running = 1", (kind,)
+        ).fetchone()[0]
+        if running >= max_running:
+            return False
+        connection.execute(
+            "INSERT INTO admissions VALUES (?, ?, NULL, 0, 1, ?) ON CONFLICT (ticket) DO UPDATE"
+            " SET running = 1, expires = excluded.expires",
+            (ticket, kind, now + duration),
+        )
+    return True
+
+
+def remove_admission(ticket):
+    _connect().execute("DELETE FROM admissions WHERE ticket = ?", (ticket,))
+
+
+def get_admissions():
+    """
+    Returns a dict of kind to dict with the number of tickets (count),
+    running tickets (running) and their total size (size).
+    """
+    rows = _connect().execute(
+        "SELECT kind, COUNT(*) AS count, SUM(running) AS running, SUM(size) AS size"
+        " FROM admissions WHERE expires >= ? GROUP BY kind",
+        (time.time(),),
+    ).fetchall()
+    return {row["kind"]: {"count": row["count"], "running": row["running"], "size": row["size"]} for row in rows}
@@ -1,117 +1,235 @@
 import glob
-import json
 import os
+import shutil
 import uuid
-import zipfile
 
 from datetime import datetime
-from flask import Flask, request, redirect, flash, jsonify, render_template, url_for, send_file
+from flask import Blueprint, Flask, Response, current_app, request, redirect, flash, jsonify, render_template, url_for, send_file
 from flask_session import Session
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 
-from sartopo2faks import classify_features
+import admission
+import decompress
+import downloads
+import featurecache
+import jobqueue
+import jobstore
+import metrics
+import resultcache
+import storage
+from sartopo2faks import DEFAULT_COMPRESS_LEVEL, GEOJSON_SEQ_SUFFIX
 from scheduler import DEFAULT_EXPIRATION_TIME, delete_job, load_scheduled_jobs, schedule_job, init_scheduler, \
     load_generated_jobs, delete_generated_jobs
 
-app = Flask(__name__)
+bp = Blueprint('fakspy', __name__)
 sess = Session()
 
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'output'
 
-# Create directories if not exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
-
-@app.route('/')
+# Maximum number of features returned per page by the feature listing
+MAX_PAGE_SIZE = 1000
+
+# Geometry types of areas offered for selecting the features within them
+AREA_TYPES = ('Polygon', 'MultiPolygon')
+
+def create_app(config=None):
+    """
+    Create the web app, with the settings in config overriding the defaults.
+
+    Importing this module starts nothing. The scheduler deleting expired
+    jobs is started here unless START_SCHEDULER is False (for tools and
+    tests), while the job store and the geo modules (numpy and shapely)
+    are loaded when first used.
+    """
+    app = Flask(__name__)
+
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
+    # Job store and cache of conversion results, shared by all workers
+    app.config['JOB_STORE_FILE'] = jobstore.DEFAULT_JOB_STORE_FILE
+    app.config['RESULT_CACHE_FOLDER'] = resultcache.DEFAULT_CACHE_FOLDER
+
+    # Sink files are written straight into the download zip
+    app.config['ZIP_COMPRESS_LEVEL'] = DEFAULT_COMPRESS_LEVEL
+    app.config['COMPACT_JSON'] = False
+    app.config['SKIP_EMPTY_SINKS'] = False
+    # GeoJSON text sequences (.geojsons, one feature per line) for streaming
+    # large sink files, instead of FeatureCollections imported by FAKS
+    app.config['GEOJSON_SEQ'] = False
+
+    # Number of worker processes converting files (0 converts in the request)
+    app.config['CONVERSION_WORKERS'] = jobqueue.DEFAULT_MAX_WORKERS
+
+    # Limits for uploads, as received (compressed) and after decompression
+    app.config['MAX_UPLOAD_SIZE'] = decompress.DEFAULT_MAX_UPLOAD_SIZE
+    app.config['MAX_DECOMPRESSED_SIZE'] = decompress.DEFAULT_MAX_DECOMPRESSED_SIZE
+
+    # Small jobs are kept in memory (tmpfs) within a byte budget shared by all
+    # workers, and moved to disk when not used for the TTL (see storage.py).
+    # Set MEMORY_STORAGE_FOLDER to None to keep all jobs on disk.
+    app.config['MEMORY_STORAGE_FOLDER'] = storage.DEFAULT_MEMORY_FOLDER
+    app.config['MEMORY_STORAGE_BUDGET'] = storage.DEFAULT_MEMORY_BUDGET
+    app.config['MEMORY_STORAGE_MAX_JOB_SIZE'] = storage.DEFAULT_MEMORY_MAX_JOB_SIZE
+    app.config['MEMORY_STORAGE_TTL'] = storage.DEFAULT_MEMORY_TTL
+
+    # Admission control (see admission.py): requests over these limits,
+    # shared by all workers, are refused with 429 or 503 and Retry-After.
+    # Conversions of uploads up to FAST_LANE_MAX_SIZE run in a fast lane
+    # with FAST_LANE_CONVERSIONS slots of their own.
+    app.config['MAX_CONCURRENT_CONVERSIONS'] = admission.DEFAULT_MAX_CONCURRENT_CONVERSIONS
+    app.config['MAX_QUEUED_CONVERSIONS'] = admission.DEFAULT_MAX_QUEUED_CONVERSIONS
+    app.config['MAX_QUEUED_CONVERSIONS_PER_CLIENT'] = admission.DEFAULT_MAX_QUEUED_CONVERSIONS_PER_CLIENT
+    app.config['MAX_INFLIGHT_UPLOAD_BYTES'] = admission.DEFAULT_MAX_INFLIGHT_UPLOAD_BYTES
+    app.config['FAST_LANE_MAX_SIZE'] = admission.DEFAULT_FAST_LANE_MAX_SIZE
+    app.config['FAST_LANE_CONVERSIONS'] = admission.DEFAULT_FAST_LANE_CONVERSIONS
+    app.config['ADMISSION_RETRY_AFTER'] = admission.DEFAULT_RETRY_AFTER
+    # Seconds a request waits for a conversion slot before it is refused
+    app.config['ADMISSION_SLOT_TIMEOUT'] = admission.DEFAULT_SLOT_TIMEOUT
+
+    # Log a structured line for requests and jobs slower than this (in seconds)
+    app.config['SLOW_JOB_SECONDS'] = None
+
+    # Delete expired jobs in the background
+    app.config['START_SCHEDULER'] = True
+
+    app.config.update(config or {})
+
+    # Create directories if not exist
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
+    jobstore.configure(app.config['JOB_STORE_FILE'])
+    resultcache.configure(app.config['RESULT_CACHE_FOLDER'])
+
+    # Decompress gzip encoded request bodies (within the limits above)
+    app.wsgi_app = decompress.UploadLimits(app.wsgi_app, app.config)
+
+    app.register_blueprint(bp)
+
+    if app.config['START_SCHEDULER']:
+        init_scheduler(app)
+    return app
+
+@bp.route('/')
 def home_page():
     # Render the upload form
     return render_template('index.html')
 
-@app.route('/about')
+@bp.route('/about')
 def about_page():
     return render_template('about.html')
 
-@app.route('/help')
+@bp.route('/help')
 def help_page():
     return render_template('help.html')
 
-@app.route('/privacy')
+@bp.route('/privacy')
 def privacy_page():
     return render_template(
         'privacy.html',
         delete_after=f"{int(DEFAULT_EXPIRATION_TIME.total_seconds() / 60)} minutter"
     )
 
-@app.route('/tos')
+@bp.route('/tos')
 def tos_page():
     return render_template('tos.html')
 
-@app.route('/process', methods=['POST'])
+@bp.route('/process', methods=['POST'])
 def process():
     # Generate a unique job id using a UUID
     job_id = f"{uuid.uuid4()}"
 
-    # Secure the filename and save it to UPLOAD_FOLDER
-    upload_path = upload(job_id)
-
-    # Determine the action (either 'select' or 'convert')
-    action = request.form.get('action')
-    if action == 'select':
-        return list_features(job_id, upload_path)
-    elif action == 'convert':
-        return convert(job_id, upload_path, [])
-    else:
-        flash('Invalid action specified!', 'error')
-        return redirect(request.url)
+    # Both actions parse the upload. Refuse right away (429/503), before
+    # the upload is received, when the conversion queue is full or too many
+    # bytes are being received by all workers, and put small uploads in the
+    # fast lane.
+    timings = {}
+    slot = admission.admit_conversion(current_app, request.content_length, request.remote_addr)
+    handed_over = False
+    try:
+        # Secure the filename and save it to UPLOAD_FOLDER
+        ticket = admission.admit_upload(current_app, request.content_length)
+        try:
+            upload_path = upload(job_id, timings)
+        finally:
+            admission.release(ticket)
+        if not isinstance(upload_path, str):
+            # Redirected, no file was uploaded
+            return upload_path
+
+        # Determine the action (either 'select' or 'convert')
+        action = request.form.get('action')
+        try:
+            # Compressed uploads were admitted by their compressed size, put
+            # them in the lane for their decompressed size
+            slot = admission.readmit_conversion(
+                current_app, slot, os.path.getsize(upload_path), request.remote_addr
+            )
+            if action == 'select':
+                # Parse within the conversion slots of the lane
+                admission.start_in_request(current_app, slot)
+        except HTTPException:
+            # Refused, nothing is kept
+            delete_job(current_app, job_id)
+            raise
+
+        if action == 'select':
+            return list_features(job_id, upload_path, timings)
+        elif action == 'convert':
+            # The conversion releases the slot when it is done
+            handed_over = True
+            return convert(job_id, upload_path, None, timings, slot=slot)
+        else:
+            flash('Invalid action specified!', 'error')
+            return redirect(request.url)
+    finally:
+        if not handed_over:
+            admission.release(slot['ticket'])
+
+# Get optional geometry simplification options from the submitted form
+def get_reduce_options():
+    tolerance = request.form.get('simplify_tolerance', type=float)
+    precision = request.form.get('precision', type=int)
+    return {
+        'tolerance': tolerance if tolerance and tolerance > 0 else None,
+        'precision': precision if precision is not None and precision >= 0 else None,
+    }
 
 # Get the list of features from the uploaded GeoJSON file
-def list_features(job_id, upload_path):
+def list_features(job_id, upload_path, timings):
     try:
-        # Open uploaded GeoJSON file
-        with open(upload_path, 'r') as file:
-            geojson_data = json.load(file)
-            features = geojson_data.get('features', [])
-
-        # Create a dictionary to map folderId to folder
-        # names (for 'Folder' features)
-        folder_mapping = {}
-        for feature in features:
-            folder_id = feature.get('id')
-            properties = feature.get('properties', {})
-            if properties.get('class', '') == 'Folder':
-                if folder_id:
-                    folder_mapping[folder_id] = properties.get('title', 'None')
-
-        feature_list = []
-        # Extract feature properties (like 'id' or 'name') for rendering
-        for i, feature in enumerate(features):
-            geometry = feature.get('geometry', {})
-            properties = feature.get('properties', {})
-            if geometry:
-                folder_id = properties.get('folderId')
-                folder_name = folder_mapping.get(folder_id, 'None')
-                feature_list.append({
-                    'id': i,
-                    'name': f"[{folder_name}]"
-                            f"[{properties.get('class', '')}] "
-                            f"{properties.get('title', 'Unknown')}",
-                    'folder': folder_name
-                })
-
-        return render_template('select.html',
-            job_id=job_id,
-            features=feature_list,
-            upload_file=os.path.basename(upload_path)
-        )
+        # Parse uploaded GeoJSON file once (unless the same content has been
+        # uploaded before) and leave an index of its features for the export
+        with metrics.timed(timings, "list_parse"):
+            index = resultcache.load_index(upload_path)
+
+        # Features are loaded by the page in batches (see job_features),
+        # areas (loaded the same way) can be used to select all features
+        # within them
+        listing = featurecache.get_listing(upload_path, index)
+        area_count = sum(1 for feature in listing if feature['type'] in AREA_TYPES)
+
+        with metrics.timed(timings, "list_render"):
+            page = render_template('select.html',
+                job_id=job_id,
+                total=len(listing),
+                folders=sorted({feature['folder'] for feature in listing}),
+                area_count=area_count,
+                area_types=','.join(AREA_TYPES),
+                upload_file=os.path.basename(upload_path),
+                reduce_options=get_reduce_options(),
+            )
+
+        metrics.record_stats({"timings": timings, "features": len(index.entries)}, stage="list")
+        metrics.log_if_slow("list", job_id, timings, current_app.config['SLOW_JOB_SECONDS'],
+                            features=len(index.entries))
+        return page
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-def upload(job_id):
+def upload(job_id, timings):
     # Check if the post request has the file part
     if 'geojson_file' not in request.files:
         flash('No file uploaded!', 'error')
@@ -124,122 +242,274 @@ def upload(job_id):
         flash('No selected file!', 'error')
         return redirect(request.url)
 
-    # Secure the filename and save it to UPLOAD_FOLDER
-    filename = secure_filename(file.filename)
+    # Uploads can be compressed (.geojson.gz or .zip)
+    max_size = current_app.config['MAX_DECOMPRESSED_SIZE']
+    reader, filename = decompress.open_upload(file.stream, file.filename, max_size)
 
-    # Generate a unique folder
-    unique_folder = f"job_{job_id}"
-    upload_folder = os.path.join(UPLOAD_FOLDER, unique_folder)
+    # Secure the filename and save it to UPLOAD_FOLDER
+    filename = secure_filename(filename)
 
-    # Ensure the unique upload folder exists (create it if necessary)
-    os.makedirs(upload_folder, exist_ok=True)
+    # Create a unique upload folder, in memory if the upload is small (the
+    # size of compressed uploads is not known until they are saved)
+    compressed = reader is not file.stream
+    upload_folder = storage.create_job(
+        current_app, job_id, None if compressed else request.content_length
+    )
 
     upload_path = os.path.join(upload_folder, filename)
-    file.save(upload_path)
+    # Decompress and hash the content while saving it, to find earlier results for it
+    try:
+        with metrics.timed(timings, "upload_save"):
+            resultcache.save_upload(reader, upload_path, max_size)
+    except Exception:
+        # Too large or invalid, nothing is kept
+        shutil.rmtree(upload_folder, ignore_errors=True)
+        jobstore.remove_job_storage(job_id)
+        raise
+    upload_path = storage.update_job_size(current_app, job_id, upload_path)
+    metrics.record_stats({"input_bytes": os.path.getsize(upload_path)})
 
     # Schedule the file for deletion
     create_time = datetime.now()
     delete_time = create_time + DEFAULT_EXPIRATION_TIME
-    schedule_job(app, filename, job_id, create_time, delete_time)
+    schedule_job(current_app, filename, job_id, create_time, delete_time)
 
     return upload_path
 
-def convert(job_id, upload_path, selected_ids):
+def convert(job_id, upload_path, selected_ids, timings, slot=None):
+    claimed = False
+    submitted = False
     try:
 
-        if not os.path.exists(upload_path):
-            return redirect(url_for('home_page'))
-
-        # Load original GeoJSON data
-        with open(upload_path, 'r') as file:
-            geojson_data = json.load(file)
+        # Claim the job so it is not moved to disk while converted (waits
+        # if it is being moved), and find its files after that
+        jobqueue.claim_job(job_id)
+        claimed = True
+        upload_folder, sink_path = storage.get_job_folders(current_app, job_id)
+        upload_path = os.path.join(upload_folder, os.path.basename(upload_path))
 
-        # Filter features based on user selection
-        if selected_ids:
-            filtered_features = [geojson_data['features'][int(i)] for i in selected_ids]
-        else:
-            filtered_features = geojson_data['features']
-
-        source_data = { "features": filtered_features }
+        if not os.path.exists(upload_path):
+            return redirect(url_for('.home_page'))
 
-        # Prepare working on job
-        unique_folder = f"job_{job_id}"
+        # Refuse right away (429/503) when the conversion queue is full, and
+        # put small uploads in the fast lane (unless admitted already)
+        if slot is None:
+            slot = admission.admit_conversion(
+                current_app, os.path.getsize(upload_path), request.remote_addr
+            )
 
-        # Output feature files to unique job folder
-        sink_path = os.path.join(app.config['OUTPUT_FOLDER'], unique_folder)
+        # Output feature files to unique job folder (next to the upload,
+        # in memory or on disk)
+        os.makedirs(sink_path, exist_ok=True)
 
         # Remove old files
         files = glob.glob(f"{sink_path}/*")
-        for f in files: os.remove(f)
-
-        classify_features(source_data, sink_path)
-        processed_files = [os.path.join(sink_path, file) for file in os.listdir(sink_path)
-                           if os.path.isfile(os.path.join(sink_path, file))]
+        for f in files:
+            if os.path.isdir(f):
+                shutil.rmtree(f)
+            else:
+                os.remove(f)
 
         upload_name = get_file_name_without_ext(upload_path)
-        zip_path = os.path.join(
-            app.config['OUTPUT_FOLDER'], unique_folder, f"{upload_name}.zip"
-        )
-
-        # Zip all files in the sink folder
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for file in processed_files:
-                zipf.write(file, os.path.basename(file))
-
-        # Return redirect URL for client to initiate automatic download
-        job_url = url_for('job',job_id=job_id)
+        zip_path = os.path.join(sink_path, f"{upload_name}.zip")
+
+        options = {
+            'compress_level': current_app.config['ZIP_COMPRESS_LEVEL'],
+            'compact': current_app.config['COMPACT_JSON'],
+            'skip_empty': current_app.config['SKIP_EMPTY_SINKS'],
+            'sequence': current_app.config['GEOJSON_SEQ'],
+            **get_reduce_options(),
+        }
+
+        # Queue conversion of the selected features, sink files are written
+        # directly into the zip file when it runs. Results for uploads with
+        # the same content, selection and options are reused.
+        with metrics.timed(timings, "convert_submit"):
+            jobqueue.submit(
+                sink_path,
+                upload_path,
+                selected_ids,
+                zip_path,
+                options=options,
+                max_workers=current_app.config['CONVERSION_WORKERS'],
+                cache_key=resultcache.result_key(
+                    resultcache.read_content_hash(upload_path), selected_ids, options
+                ),
+                slow_job_seconds=current_app.config['SLOW_JOB_SECONDS'],
+                slot=slot,
+                claim=job_id,
+            )
+            submitted = True
+        metrics.record_stats({"timings": timings})
+
+        # Return redirect URL for client to follow the job and
+        # initiate automatic download when it is done
+        job_url = url_for('.job',job_id=job_id)
         return redirect(f"{job_url}?dl=1")
 
+    except HTTPException:
+        raise
     except Exception as e:
         flash(f"Error while converting file: {str(e)}", 'error')
         return redirect(request.url)
+    finally:
+        # Submitted jobs release their slot and claim when done
+        if slot is not None and not submitted:
+            admission.release(slot['ticket'])
+        if claimed and not submitted:
+            jobqueue.release_job(job_id)
+
+@bp.route('/job/<job_id>/features')
+def job_features(job_id):
+    # Page through the features of the upload (with geometry), optionally
+    # filtered by 'folder', 'class', 'type' (comma separated), 'title' or
+    # search words ('q').
+    # With 'ids_only' the ids of all matching features are returned instead.
+    try:
+        upload_path = get_upload_path(job_id)
+        index = featurecache.get_or_build_index(upload_path)
+        features = featurecache.filter_listing(
+            featurecache.get_listing(upload_path, index),
+            folder=request.args.get('folder') or None,
+            feature_class=request.args.get('class') or None,
+            geometry_type=request.args.get('type', '').split(',') if request.args.get('type') else None,
+            title=request.args.get('title') or None,
+            query=request.args.get('q') or None,
+        )
+        if request.args.get('ids_only'):
+            return jsonify({"total": len(features), "ids": [feature['id'] for feature in features]})
+
+        page = get_page_args()
+        page['limit'] = max(0, min(page['limit'], MAX_PAGE_SIZE))
+        page['offset'] = max(0, page['offset'])
+        return jsonify({
+            "total": len(features),
+            **page,
+            "features": features[page['offset']:page['offset'] + page['limit']],
+        })
+
+    except FileNotFoundError:
+        return jsonify({"error": "Job not found"}), 404
+
+@bp.route('/job/<job_id>/features/intersecting')
+def job_features_intersecting(job_id):
+    # Find features intersecting a feature in the upload (like an
+    # assignment) or a bounding box given as 'minLng,minLat,maxLng,maxLat'
+    import shapely
+    import spatial
+
+    try:
+        upload_path = get_upload_path(job_id)
+        index = featurecache.get_or_build_index(upload_path)
+
+        if 'feature' in request.args:
+            area_id = int(request.args['feature'])
+            area = featurecache.read_features(upload_path, index, [area_id]).features
+            area = spatial.to_shapely([area[0].geometry])[0]
+            if area is None:
+                return jsonify({"error": "Feature has no geometry"}), 400
+        elif 'bbox' in request.args:
+            area = shapely.box(*[float(v) for v in request.args['bbox'].split(',')])
+        else:
+            return jsonify({"error": "Either 'feature' or 'bbox' is required"}), 400
 
-@app.route('/export', methods=['POST'])
+        ids = featurecache.find_intersecting(upload_path, index, area)
+        return jsonify({"ids": ids})
+
+    except FileNotFoundError:
+        return jsonify({"error": "Job not found"}), 404
+    except (ValueError, IndexError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
+
+@bp.route('/export', methods=['POST'])
 def export():
     job_id = request.form.get('job_id')
     upload_file = request.form.get('upload_file')
-    selected_ids = request.form.getlist('features')  # Extract selected feature IDs
-    upload_path = os.path.join(UPLOAD_FOLDER, f"job_{job_id}", upload_file)
-    return convert(job_id, upload_path, selected_ids)
+    try:
+        upload_path = get_upload_path(job_id)
+        if os.path.basename(upload_path) != upload_file:
+            raise FileNotFoundError(f"No upload named {upload_file}")
+        selected_ids = get_selection(upload_path)
+    except (ValueError, FileNotFoundError) as e:
+        return jsonify({"error": str(e)}), 400
+    return convert(job_id, upload_path, selected_ids, {})
+
+# Get the selected feature ids from the export form. Features are selected
+# by rules ('folder', 'class' and 'type', and 'exclude_<column>', each with
+# comma separated values), by id ranges ('selection', like '0-99,105'), or
+# by one 'features' field per id. Rules and ranges can be combined. Returns
+# None if nothing is selected (export everything).
+def get_selection(upload_path):
+    include = get_selection_rules('')
+    exclude = get_selection_rules('exclude_')
+    ranges = request.form.get('selection')
+    if not include and not exclude and ranges is None:
+        return request.form.getlist('features') or None
+
+    index = featurecache.get_or_build_index(upload_path)
+    selected_ids = None
+    if include or exclude:
+        selected_ids = featurecache.select_ids(upload_path, index, include, exclude)
+    if ranges is not None:
+        ids = featurecache.parse_ranges(ranges, len(index.entries))
+        if selected_ids is not None:
+            matching = set(selected_ids)
+            ids = [i for i in ids if i in matching]
+        selected_ids = ids
+    return selected_ids
+
+def get_selection_rules(prefix):
+    rules = {}
+    for column in ('folder', 'class', 'type'):
+        values = [
+            value.strip()
+            for field in request.form.getlist(f"{prefix}{column}")
+            for value in field.split(',')
+            if value.strip()
+        ]
+        if values:
+            rules[column] = values
+    return rules
 
 # Get the only file in the upload folder
 def get_file_name_without_ext(file):
     return os.path.splitext(os.path.basename(file))[0]
 
-# Get the only file in the upload folder
+# Get the name of the file uploaded in the job
 def get_upload_file(job_id):
-    job_path = os.path.join(
-        app.config['UPLOAD_FOLDER'], f"job_{job_id}"
-    )
-    files = [f for f in os.listdir(job_path)
-        if os.path.isfile(os.path.join(job_path, f))]
+    return storage.get_job_files(current_app, job_id)['upload_file']
 
-    # Assuming there's only one file in the folder
-    if len(files) > 0:
-        # Return first file name without extension
-        return files[0]
-    else:
-        raise FileNotFoundError("No files found in the upload folder.")
+# Get the path of the file uploaded in the job
+def get_upload_path(job_id):
+    return storage.get_job_files(current_app, job_id)['upload_path']
 
-@app.route('/job/<job_id>')
+@bp.route('/job/<job_id>')
 def job(job_id):
-    # Locate the file to download
-    job_path = os.path.join(
-        app.config['OUTPUT_FOLDER'], f"job_{job_id}"
-    )
-    if not os.path.exists(job_path):
-        return redirect(url_for('home_page'))
-
-    upload_file = get_upload_file(job_id)
+    # Locate the job from the job store
+    try:
+        files = storage.get_job_files(current_app, job_id)
+    except FileNotFoundError:
+        return redirect(url_for('.home_page'))
+    job_path = files['output_folder']
+
+    # Jobs converted before the job queue existed have no status
+    status = jobqueue.read_status(job_path)
+    if status is None:
+        if not os.path.exists(job_path):
+            return redirect(url_for('.home_page'))
+        status = {'state': jobqueue.DONE}
+    storage.touch_job(job_id)
+
+    upload_file = files['upload_file']
     upload_name = get_file_name_without_ext(upload_file)
 
     delete_url = url_for(
-        'delete',
+        '.delete',
         job_id=job_id,
     )
 
     download_url = url_for(
-        'download',
+        '.download',
         job_id=job_id,
     )
 
@@ -257,52 +527,151 @@ def job(job_id):
         download_automatic = download_automatic,
         delete_after=f"{duration} minutter",
         delete_url=delete_url,
+        status_url=url_for('.job_status', job_id=job_id),
+        status=status,
+        sink_files=downloads.list_sink_files(files['zip_path'])
+            if status['state'] == jobqueue.DONE else [],
     )
 
-@app.route('/download/<job_id>')
+@bp.route('/job/<job_id>/status')
+def job_status(job_id):
+    _, job_path = storage.get_job_folders(current_app, job_id)
+    status = jobqueue.read_status(job_path)
+    if status is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(status)
+
+@bp.route('/download/<job_id>')
 def download(job_id):
 
-    upload_file = get_upload_file(job_id)
-    upload_name = get_file_name_without_ext(upload_file)
-    # Locate the file to download
-    zip_path = os.path.join(
-        app.config['OUTPUT_FOLDER'], f"job_{job_id}", f"{upload_name}.zip"
-    )
+    # Locate the file to download, and stream it to the client
+    try:
+        zip_path = get_zip_path(job_id)
+        response = send_file(os.path.abspath(zip_path), as_attachment=True)
+    except FileNotFoundError:
+        return redirect(url_for('.home_page'))
+    storage.touch_job(job_id)
 
-    if not os.path.exists(zip_path):
-        return redirect(url_for('home_page'))
+    return response
 
-    # Stream the file to the client
-    response = send_file(zip_path, as_attachment=True)
+# Get the path of the zip file with the sink files of the job
+def get_zip_path(job_id):
+    return storage.get_job_files(current_app, job_id)['zip_path']
 
+@bp.route('/download/<job_id>/<sink_file>')
+def download_sink(job_id, sink_file):
+    # Serve a single sink file from the zip, gzip compressed if the client
+    # accepts it. ETags, conditional and range requests are handled by send_file.
+    gzip = request.accept_encodings['gzip'] > 0
+    try:
+        path, etag = downloads.get_sink_file(
+            get_zip_path(job_id), sink_file, gzip,
+            on_extract=lambda size: storage.add_job_size(job_id, size),
+        )
+    except FileNotFoundError:
+        return jsonify({"error": "File not found"}), 404
+
+    response = send_file(
+        os.path.abspath(path),
+        mimetype='application/geo+json-seq' if sink_file.endswith(GEOJSON_SEQ_SUFFIX) else 'application/geo+json',
+        as_attachment=True,
+        download_name=sink_file,
+        etag=etag,
+        conditional=True,
+    )
+    if gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
     return response
 
-@app.route('/job/<job_id>/delete', methods=['POST'])
+@bp.route('/job/<job_id>/delete', methods=['POST'])
 def delete(job_id):
 
-    delete_job(app, job_id)
+    # Also delete cached results made from the same content
+    try:
+        resultcache.discard(resultcache.read_content_hash(get_upload_path(job_id)))
+    except FileNotFoundError:
+        pass
+    delete_job(current_app, job_id)
+
+    return redirect(url_for('.home_page'))
+
+# Get paging parameters ('limit' and 'offset') from the query string
+def get_page_args():
+    return {
+        'limit': request.args.get('limit', 100, type=int),
+        'offset': request.args.get('offset', 0, type=int),
+    }
 
-    return redirect(url_for('home_page'))
+# Get an ISO 8601 date/time from the query string
+def get_time_arg(name):
+    value = request.args.get(name)
+    return datetime.fromisoformat(value) if value else None
 
-@app.route('/job/generated')
+def page_response(total, jobs, page):
+    return jsonify({"total": total, **page, "jobs": jobs})
+
+@bp.route('/job/generated')
 def job_generated():
-    return jsonify(load_generated_jobs())
+    try:
+        page = get_page_args()
+        total, jobs = load_generated_jobs(
+            **page,
+            upload_file=request.args.get('upload_file'),
+            created_after=get_time_arg('created_after'),
+            created_before=get_time_arg('created_before'),
+        )
+        return page_response(total, jobs, page)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-@app.route('/job/generated/delete', methods=['POST'])
+@bp.route('/job/generated/delete', methods=['POST'])
 def job_generated_delete():
-    return jsonify(delete_generated_jobs())
+    return jsonify({"deleted": delete_generated_jobs()})
 
-@app.route('/job/scheduled')
+@bp.route('/job/scheduled')
 def job_scheduled():
-    return jsonify(load_scheduled_jobs())
-
-init_scheduler(app)
+    try:
+        page = get_page_args()
+        total, jobs = load_scheduled_jobs(
+            **page,
+            expires_after=get_time_arg('expires_after'),
+            expires_before=get_time_arg('expires_before'),
+        )
+        return page_response(total, jobs, page)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@bp.route('/metrics')
+def metrics_page():
+    generated_jobs, _ = load_generated_jobs(limit=0)
+    scheduled_jobs, _ = load_scheduled_jobs(limit=0)
+    cache = jobstore.get_counters("result_cache_")
+    admitted = admission.get_stats()
+    text = metrics.render({
+        "fakspy_queue_depth": ("Conversion jobs queued or running in this worker", jobqueue.queue_depth()),
+        "fakspy_queued_conversions": ("Conversions waiting for a slot in all workers", admitted["queued_conversions"]),
+        "fakspy_running_conversions": ("Conversions running in all workers", admitted["running_conversions"]),
+        "fakspy_inflight_upload_bytes": ("Bytes of uploads being received by all workers", admitted["inflight_upload_bytes"]),
+        "fakspy_generated_jobs": ("Jobs in the job store", generated_jobs),
+        "fakspy_scheduled_jobs": ("Jobs scheduled for deletion", scheduled_jobs),
+    }, counters={
+        "fakspy_admission_rejected_total": ("Requests refused by admission control", admitted["rejected"]),
+        "fakspy_result_cache_hits_total": ("Conversions served from the result cache", cache.get(resultcache.HITS, 0)),
+        "fakspy_result_cache_misses_total": ("Conversions not found in the result cache", cache.get(resultcache.MISSES, 0)),
+    })
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+@bp.route('/cache/stats')
+def cache_stats():
+    return jsonify(resultcache.get_stats())
 
 if __name__ == "__main__":
 
     # Quick test configuration. Please use proper Flask configuration options
     # in production settings, and use a separate file or environment variables
     # to manage the secret key!
+    app = create_app()
     app.secret_key = 'some_secret_key'
     app.config['SESSION_TYPE'] = 'filesystem'
 
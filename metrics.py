@@ -0,0 +1,146 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Minimal in-process metrics with Prometheus text output. Each web worker
+# keeps its own histograms. Conversions running in worker processes return
+# their measurements with the job status, and are recorded by the web
+# worker that submitted them.
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+COUNT_BUCKETS = (1, 10, 100, 1000, 10_000, 100_000, 1_000_000)
+
+_lock = threading.Lock()
+_registry = []
+
+
+class Histogram:
+    """
+    Prometheus histogram with optional labels.
+    """
+
+    def __init__(self, name, help, buckets, labelnames=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        # Label values to (bucket counts, sum, count)
+        self.series = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with _lock:
+            counts, total, count = self.series.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            i = bisect_left(self.buckets, value)
+            if i < len(counts):
+                counts[i] += 1
+            self.series[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            series = sorted((key, (list(counts), total, count))
+                            for key, (counts, total, count) in self.series.items())
+        for key, (counts, total, count) in series:
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(labels, bound)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(labels, '+Inf')} {count}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(labels)} {count}")
+        return lines
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels, le=None):
+    if le is not None:
+        labels = labels + [f'le="{le}"']
+    return f"{{{','.join(labels)}}}" if labels else ""
+
+
+stage_duration = Histogram(
+    "fakspy_stage_duration_seconds", "Time spent in each stage of a request or job", DURATION_BUCKETS, ("stage",)
+)
+input_bytes = Histogram(
+    "fakspy_input_bytes", "Size of uploaded files", BYTES_BUCKETS
+)
+feature_count = Histogram(
+    "fakspy_features", "Number of features listed or converted", COUNT_BUCKETS, ("stage",)
+)
+sink_bytes = Histogram(
+    "fakspy_sink_output_bytes", "Uncompressed size of each sink file written", BYTES_BUCKETS, ("sink",)
+)
+
+
+@contextmanager
+def timed(timings, stage):
+    """
+    Measure the time spent in the block and store it in the timings dict
+    by stage. Timings are recorded later with record_stats(), so they can
+    be measured in another process.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+def record_stats(stats, stage="convert"):
+    """
+    Record measurements from a request or a job (see jobqueue.convert_upload).
+    """
+    for name, elapsed in stats.get("timings", {}).items():
+        stage_duration.observe(elapsed, stage=name)
+    if "input_bytes" in stats:
+        input_bytes.observe(stats["input_bytes"])
+    if "features" in stats:
+        feature_count.observe(stats["features"], stage=stage)
+    for sink, size in stats.get("sink_bytes", {}).items():
+        sink_bytes.observe(size, sink=sink)
+
+
+def log_if_slow(kind, job_id, timings, threshold, **fields):
+    """
+    Log a structured (JSON) line if the stages took longer than threshold
+    seconds in total. Does nothing if threshold is None.
+    """
+    total = sum(timings.values())
+    if threshold is None or total < threshold:
+        return
+    logger.warning(json.dumps({
+        "event": f"slow_{kind}",
+        "job_id": job_id,
+        "seconds": round(total, 3),
+        "timings": {stage: round(elapsed, 3) for stage, elapsed in timings.items()},
+        **fields,
+    }))
+
+
+def render(gauges=None, counters=None):
+    """
+    Returns all metrics in Prometheus text format. Gauges and counters are
+    given as dicts of metric name to (help, value), counter names end with
+    "_total".
+    """
+    lines = []
+    for histogram in _registry:
+        lines.extend(histogram.render())
+    for kind, metrics in (("gauge", gauges), ("counter", counters)):
+        for name, (help, value) in (metrics or {}).items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,303 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+
+import decompress
+import featurecache
+import jobstore
+import rules
+
+# Shared cache of conversion results, addressed by the content of the
+# upload. Uploads are hashed while they are saved, and the parsed index
+# and the converted zip files for an upload are kept in a folder named by
+# the hash (cache/<sha256>/), so the same SARTopo export uploaded again by
+# someone else is listed and converted without parsing it again.
+
+# Default cache folder (RESULT_CACHE_FOLDER in the app config)
+DEFAULT_CACHE_FOLDER = "cache"
+CONTENT_HASH_FILE = "upload.sha256"
+
+# Cached data is deleted when it expires (counted from when it was stored),
+# or earlier when the cache is full (least recently used first). Keep the
+# TTL at most as long as uploads are kept, so cached data is not kept
+# longer than the uploads it was made from. The cache is evicted by the
+# scheduler (see evict), not by the conversions adding to it.
+MAX_SIZE = 1024 * 1024 * 1024
+TTL = timedelta(minutes=10)
+
+# Counters in the job store
+HITS = "result_cache_hits"
+MISSES = "result_cache_misses"
+INDEX_HITS = "result_cache_index_hits"
+INDEX_MISSES = "result_cache_index_misses"
+
+_cache_root = DEFAULT_CACHE_FOLDER
+
+
+def configure(folder):
+    """
+    Keep cached data in the given folder (made absolute, so it does not
+    move with the working folder).
+    """
+    global _cache_root
+    _cache_root = os.path.abspath(folder)
+
+
+def get_folder():
+    return _cache_root
+
+
+def save_upload(reader, upload_path, max_size=None):
+    """
+    Save an uploaded file (read in chunks from reader, see
+    decompress.open_upload) and return the SHA-256 hash of its content,
+    computed while the file is written.
+    """
+    digest = hashlib.sha256()
+    with open(upload_path, "wb") as f:
+        decompress.copy_limited(reader, f, max_size, on_chunk=digest.update)
+    content_hash = digest.hexdigest()
+
+    # Remember the hash for later requests in the same job
+    hash_path = get_content_hash_path(upload_path)
+    os.makedirs(os.path.dirname(hash_path), exist_ok=True)
+    with open(hash_path, "w") as f:
+        f.write(content_hash)
+    return content_hash
+
+
+def get_content_hash_path(upload_path):
+    return os.path.join(
+        os.path.dirname(upload_path), featurecache.CACHE_FOLDER, CONTENT_HASH_FILE
+    )
+
+
+def read_content_hash(upload_path):
+    """
+    Returns the content hash of the upload, or None if it is not known.
+    """
+    try:
+        with open(get_content_hash_path(upload_path), "r") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def result_key(content_hash, selected_ids, options):
+    """
+    Returns the cache key for converting the selected features of an upload
+    (all if selected_ids is None) with the given options and the current
+    classification rules (None if the content hash is not known).
+    """
+    if content_hash is None:
+        return None
+    # Features are written in the order they are selected
+    selection = None if selected_ids is None else [int(i) for i in selected_ids]
+    params = json.dumps(
+        {"selection": selection, "options": options, "rules": rules.get_rules().version},
+        sort_keys=True,
+    )
+    return f"{content_hash}/{hashlib.sha256(params.encode()).hexdigest()[:32]}"
+
+
+def _entry_folder(content_hash):
+    return os.path.join(_cache_root, content_hash)
+
+
+def _touch(path):
+    # Mark as recently used (atime) without changing when it was stored (mtime)
+    stat = os.stat(path)
+    os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+
+
+def _copy(source_path, target_path):
+    # Reserve a unique name, then link the source in its place
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(target_path))
+    os.close(fd)
+    try:
+        os.remove(tmp_path)
+        os.link(source_path, tmp_path)
+    except OSError:
+        # Different file system
+        shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, target_path)
+
+
+def _is_expired(path, now):
+    return os.stat(path).st_mtime < now - TTL.total_seconds()
+
+
+def load_index(upload_path):
+    """
+    Parse the upload, or reuse the index of an upload with the same content.
+
+    Returns the featurecache.FeatureIndex of the upload.
+    """
+    content_hash = read_content_hash(upload_path)
+    if content_hash is None:
+        index, _ = featurecache.parse_upload(upload_path)
+        return index
+
+    shared_path = os.path.join(_entry_folder(content_hash), featurecache.INDEX_FILE)
+    try:
+        expired = _is_expired(shared_path, time.time())
+    except FileNotFoundError:
+        expired = True
+    index = None if expired else featurecache.adopt_index(upload_path, shared_path)
+    if index is not None:
+        _touch(shared_path)
+        jobstore.increment(INDEX_HITS)
+        return index
+
+    jobstore.increment(INDEX_MISSES)
+    index, _ = featurecache.parse_upload(upload_path)
+    os.makedirs(_entry_folder(content_hash), exist_ok=True)
+    _copy(featurecache.get_index_path(upload_path), shared_path)
+    return index
+
+
+def fetch_result(key, zip_path):
+    """
+    Put a cached conversion result at zip_path.
+
+    Returns the job status stored with the result, or None on a cache miss.
+    """
+    if key is None:
+        return None
+    cached_path = os.path.join(_cache_root, f"{key}.zip")
+    try:
+        with open(os.path.join(_cache_root, f"{key}.json"), "r") as f:
+            status = json.load(f)
+        if _is_expired(cached_path, time.time()):
+            raise FileNotFoundError(cached_path)
+        _copy(cached_path, zip_path)
+        _touch(cached_path)
+    except (FileNotFoundError, json.JSONDecodeError):
+        jobstore.increment(MISSES)
+        return None
+    jobstore.increment(HITS)
+    return status
+
+
+def store_result(key, zip_path, status):
+    """
+    Add a conversion result to the cache.
+    """
+    if key is None:
+        return
+    cached_path = os.path.join(_cache_root, f"{key}.zip")
+    os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+    _copy(zip_path, cached_path)
+
+    # Write the status last, an entry without status is not used
+    status_path = os.path.join(_cache_root, f"{key}.json")
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(status_path))
+    with os.fdopen(fd, "w") as f:
+        json.dump(status, f)
+    os.replace(tmp_path, status_path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def evict(now=None):
+    """
+    Remove expired cache entries, and the least recently used entries
+    until the cache is within MAX_SIZE. Returns the number of bytes freed.
+    """
+    now = now or time.time()
+    if not os.path.isdir(_cache_root):
+        return 0
+
+    entries = []
+    total = 0
+    freed = 0
+    for content_hash in os.listdir(_cache_root):
+        folder = os.path.join(_cache_root, content_hash)
+        try:
+            names = os.listdir(folder)
+        except NotADirectoryError:
+            continue
+        for name in names:
+            if name.endswith(".tmp") or name.endswith(".json"):
+                continue
+            path = os.path.join(folder, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime < now - TTL.total_seconds():
+                _remove_entry(path)
+                freed += stat.st_size
+            else:
+                entries.append((stat.st_atime, stat.st_size, path))
+                total += stat.st_size
+
+    # Remove least recently used entries until within budget
+    for _, size, path in sorted(entries):
+        if total <= MAX_SIZE:
+            break
+        _remove_entry(path)
+        total -= size
+        freed += size
+
+    _remove_empty_folders()
+    return freed
+
+
+def _remove_entry(path):
+    _remove(path)
+    if path.endswith(".zip"):
+        _remove(f"{path[:-len('.zip')]}.json")
+
+
+def _remove_empty_folders():
+    for content_hash in os.listdir(_cache_root):
+        try:
+            os.rmdir(os.path.join(_cache_root, content_hash))
+        except OSError:
+            # Not empty (or not a folder)
+            pass
+
+
+def discard(content_hash):
+    """
+    Remove everything cached for uploads with the given content.
+    """
+    if content_hash:
+        shutil.rmtree(_entry_folder(content_hash), ignore_errors=True)
+
+
+def get_stats():
+    """
+    Returns hit and miss counts (for all workers) and the size of the cache.
+    """
+    entries = 0
+    size = 0
+    if os.path.isdir(_cache_root):
+        for folder, _, names in os.walk(_cache_root):
+            for name in names:
+                if name.endswith(".zip"):
+                    entries += 1
+                try:
+                    size += os.path.getsize(os.path.join(folder, name))
+                except FileNotFoundError:
+                    pass
+    counters = jobstore.get_counters("result_cache_")
+    return {
+        "hits": counters.get(HITS, 0),
+        "misses": counters.get(MISSES, 0),
+        "index_hits": counters.get(INDEX_HITS, 0),
+        "index_misses": counters.get(INDEX_MISSES, 0),
+        "entries": entries,
+        "size": size,
+        "max_size": MAX_SIZE,
+    }
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Classification rules (folders to sink files, mission status and point
+# categories) are read from rules.json and compiled once into lookup
+# tables and keyword automatons. The file is checked for changes at most
+# every RELOAD_INTERVAL seconds, so edited rules are picked up by the
+# command line tool, the web app and its workers without a restart.
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json")
+
+# Seconds between checks for changes in the rules file
+RELOAD_INTERVAL = 2.0
+
+# Point categories remembered by title and marker symbol (cleared when full)
+MAX_MEMO_SIZE = 10_000
+
+_lock = threading.Lock()
+_rules = None
+_mtime = None
+_checked = 0.0
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton finding the first rule (by order) with a keyword
+    contained in a text, in one pass over the text however many keywords
+    there are.
+    """
+
+    def __init__(self, keywords):
+        # Keywords are given as (keyword, rule index)
+        self.goto = [{}]
+        self.fail = [0]
+        # Lowest rule index of the keywords ending in each state
+        self.best = [None]
+
+        for keyword, rule in keywords:
+            state = 0
+            for char in keyword:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append(None)
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.best[state] = _lowest(self.best[state], rule)
+
+        # Breadth first, so fail states are done before the states using them
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.best[next_state] = _lowest(self.best[next_state], self.best[self.fail[next_state]])
+                queue.append(next_state)
+
+        # Follow the fail states up front, so matching takes one lookup per
+        # character (characters in no keyword go back to the start)
+        self.delta = [None] * len(self.goto)
+        self.delta[0] = dict(self.goto[0])
+        for state in queue:
+            self.delta[state] = {**self.delta[self.fail[state]], **self.goto[state]}
+
+    def match(self, text, limit=None):
+        """
+        Returns the lowest rule index with a keyword in text, or None if
+        there is none (or none below limit).
+        """
+        delta, best = self.delta, self.best
+        found = limit
+        state = 0
+        for char in text:
+            state = delta[state].get(char, 0)
+            rule = best[state]
+            if rule is not None and (found is None or rule < found):
+                found = rule
+                if rule == 0:
+                    break
+        return None if found == limit else found
+
+
+def _lowest(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+class Rules:
+    """
+    Compiled classification rules.
+    """
+
+    def __init__(self, config, version=None):
+        self.version = version
+        self.folder_to_sink = dict(config.get("folders", {}))
+
+        mission_status = config.get("mission_status", {})
+        self.period_statuses = {
+            title.lower(): status for title, status in mission_status.get("periods", {}).items()
+        }
+        self.statuses = {
+            status.lower(): value for status, value in mission_status.get("statuses", {}).items()
+        }
+        self.default_status = mission_status.get("default", "empty")
+
+        point_categories = config.get("point_categories", {})
+        rules = point_categories.get("rules", [])
+        self.categories = [rule["category"] for rule in rules]
+        self.default_category = point_categories.get("default", "Annet")
+        self.title_matcher = KeywordMatcher(
+            (keyword.lower(), i) for i, rule in enumerate(rules) for keyword in rule.get("title", [])
+        )
+        self.symbol_matcher = KeywordMatcher(
+            (keyword.lower(), i) for i, rule in enumerate(rules) for keyword in rule.get("marker_symbol", [])
+        )
+        self._memo = {}
+
+    def mission_status(self, period_title, status):
+        """
+        Returns the mission status of an assignment from the title of its
+        operational period (None if it has none) or else its status.
+        """
+        if period_title is not None:
+            value = self.period_statuses.get(period_title.lower())
+            if value is not None:
+                return value
+        return self.statuses.get(status.lower(), self.default_status)
+
+    def point_category(self, title, marker_symbol):
+        """
+        Returns the category of the first rule with a keyword contained in
+        the title or the marker symbol (case insensitive).
+        """
+        key = (title, marker_symbol)
+        category = self._memo.get(key)
+        if category is None:
+            rule = self.title_matcher.match(title.lower())
+            rule = _lowest(rule, self.symbol_matcher.match(marker_symbol.lower(), rule))
+            category = self.default_category if rule is None else self.categories[rule]
+            if len(self._memo) >= MAX_MEMO_SIZE:
+                self._memo.clear()
+            self._memo[key] = category
+        return category
+
+
+def load(path=RULES_PATH):
+    """
+    Returns the rules compiled from the given rules file.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    return Rules(json.loads(data), hashlib.sha256(data).hexdigest()[:16])
+
+
+def get_rules():
+    """
+    Returns the current rules, reloaded if the rules file has changed.
+
+    Rules that fail to load are reported, and the rules loaded before are
+    kept until the file is fixed.
+    """
+    global _rules, _mtime, _checked
+
+    now = time.monotonic()
+    if _rules is not None and now - _checked < RELOAD_INTERVAL:
+        return _rules
+
+    with _lock:
+        if _rules is not None and now - _checked < RELOAD_INTERVAL:
+            return _rules
+        _checked = now
+        try:
+            mtime = os.stat(RULES_PATH).st_mtime_ns
+            if _rules is None or mtime != _mtime:
+                _rules = load(RULES_PATH)
+                _mtime = mtime
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if _rules is None:
+                raise
+            print(f"Error reloading rules from '{RULES_PATH}': {e}")
+        return _rules
@@ -0,0 +1,158 @@
+import msgspec
+
+# Typed decoding of SARTopo GeoJSON exports. Only the fields used by the
+# converter are decoded, and geometry coordinates are kept as raw JSON
+# buffers until they are written to the FAKS sink files.
+
+# Feature classes used by SARTopo (stored in properties.class)
+FOLDER = "Folder"
+ASSIGNMENT = "Assignment"
+OPERATIONAL_PERIOD = "OperationalPeriod"
+
+# Number of decimals kept for coordinates in FAKS output (same as geojson)
+DEFAULT_PRECISION = 6
+
+
+class Point(msgspec.Struct, tag="Point", tag_field="type"):
+    coordinates: msgspec.Raw = msgspec.Raw(b"[]")
+
+
+class MultiPoint(msgspec.Struct, tag="MultiPoint", tag_field="type"):
+    coordinates: msgspec.Raw = msgspec.Raw(b"[]")
+
+
+class LineString(msgspec.Struct, tag="LineString", tag_field="type"):
+    coordinates: msgspec.Raw = msgspec.Raw(b"[]")
+
+
+class MultiLineString(msgspec.Struct, tag="MultiLineString", tag_field="type"):
+    coordinates: msgspec.Raw = msgspec.Raw(b"[]")
+
+
+class Polygon(msgspec.Struct, tag="Polygon", tag_field="type"):
+    coordinates: msgspec.Raw = msgspec.Raw(b"[]")
+
+
+class MultiPolygon(msgspec.Struct, tag="MultiPolygon", tag_field="type"):
+    coordinates: msgspec.Raw = msgspec.Raw(b"[]")
+
+
+class GeometryCollection(msgspec.Struct, tag="GeometryCollection", tag_field="type"):
+    geometries: msgspec.Raw = msgspec.Raw(b"[]")
+
+
+Geometry = (
+    Point | MultiPoint | LineString | MultiLineString
+    | Polygon | MultiPolygon | GeometryCollection
+)
+
+
+class Properties(msgspec.Struct):
+    # Missing fields decode to the same defaults as dict.get() did before,
+    # title and description are UNSET when missing to allow fallbacks
+    feature_class: str | None = msgspec.field(default="", name="class")
+    title: str | None | msgspec.UnsetType = msgspec.UNSET
+    number: str | int | None = ""
+    folder_id: str | None = msgspec.field(default=None, name="folderId")
+    operational_period_id: str | None = msgspec.field(default="", name="operationalPeriodId")
+    status: str | None = ""
+    marker_symbol: str | None = msgspec.field(default="", name="marker-symbol")
+    description: str | None | msgspec.UnsetType = msgspec.UNSET
+    message: str | None = ""
+
+    def get_title(self, default=""):
+        return default if self.title is msgspec.UNSET else self.title
+
+    def get_message(self):
+        return self.message if self.description is msgspec.UNSET else self.description
+
+
+class Feature(msgspec.Struct):
+    id: str | int | None = None
+    geometry: Geometry | None = None
+    properties: Properties | None = None
+
+    def __post_init__(self):
+        if self.properties is None:
+            self.properties = Properties()
+
+
+class FeatureCollection(msgspec.Struct):
+    features: list[Feature] = []
+
+
+class RawFeatureCollection(msgspec.Struct):
+    features: list[msgspec.Raw] = []
+
+
+_decoder = msgspec.json.Decoder(FeatureCollection)
+_raw_decoder = msgspec.json.Decoder(RawFeatureCollection)
+_feature_decoder = msgspec.json.Decoder(Feature)
+
+
+def decode(data):
+    """
+    Decode a SARTopo export from bytes into a FeatureCollection.
+    """
+    return _decoder.decode(data)
+
+
+def decode_raw(data):
+    """
+    Decode a SARTopo export from bytes into a RawFeatureCollection, where
+    each feature is kept as a raw JSON view into the given buffer.
+    """
+    return _raw_decoder.decode(data)
+
+
+def decode_feature(data):
+    """
+    Decode a single feature from raw JSON bytes.
+    """
+    return _feature_decoder.decode(data)
+
+
+def load(file_path):
+    """
+    Read and decode a SARTopo export from the given file path.
+    """
+    with open(file_path, "rb") as f:
+        return decode(f.read())
+
+
+def geometry_type(geometry):
+    """
+    Returns the GeoJSON type name of the given geometry ('' if None).
+    """
+    if geometry is None:
+        return ""
+    return geometry.__struct_config__.tag
+
+
+def round_coordinates(coordinates, precision=DEFAULT_PRECISION):
+    """
+    Round (nested) coordinates to the given number of decimals.
+    """
+    if not isinstance(coordinates, list):
+        return round(coordinates, precision)
+    # Round positions in one comprehension instead of a call per number
+    if coordinates and not isinstance(coordinates[0], list):
+        return [round(c, precision) for c in coordinates]
+    return [round_coordinates(c, precision) for c in coordinates]
+
+
+def to_geojson(obj):
+    """
+    Convert decoded geometries into plain GeoJSON dicts.
+
+    Intended as 'default' hook for json.dump() so that coordinates are
+    only expanded one feature at a time while writing sink files.
+    """
+    if isinstance(obj, GeometryCollection):
+        return {"type": "GeometryCollection", "geometries": msgspec.json.decode(obj.geometries)}
+    if isinstance(obj, Geometry):
+        return {
+            "type": geometry_type(obj),
+            "coordinates": round_coordinates(msgspec.json.decode(obj.coordinates) or []),
+        }
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
@@ -1,147 +1,148 @@
+import argparse
+import glob
+import hashlib
+import io
 import json
 import os
 import sys
-import geojson
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-# Mapping folders to sink files (Folder titles help categorize features)
-folder_to_sink = {
-    "01 Etterretning": "Etterretningsreflekser.geojson",
-    "02 SPOR Mannskaper": "Mobilspor.geojson",
-    "04 SPOR Motorisert": "Mobilspor.geojson",
-    "03 SPOR Hund m/Fører": "Mobilspor.geojson",
-    "05 SPOR Luftfartøy": "Mobilspor.geojson",
-    # Add more folder mappings here if needed
-}
+import msgspec
 
+import rules
+import sartopo
 
-def calculate_bounding_box(coordinates):
-    """
-    Calculate the bounding box (minLat, maxLat, minLng, maxLng) for a given Polygon's coordinates.
-    """
-    lats = [point[1] for linear_ring in coordinates for point in linear_ring]
-    lngs = [point[0] for linear_ring in coordinates for point in linear_ring]
+# numpy and shapely (through spatial) are slow to import, and only needed
+# for simplification, so they are imported when used
 
-    return {
-        "minLat": min(lats),
-        "maxLat": max(lats),
-        "minLng": min(lngs),
-        "maxLng": max(lngs)
-    }
+# Deflate level used for zip archives with sink files (None stores uncompressed)
+DEFAULT_COMPRESS_LEVEL = 6
 
-def derive_mission_status(features, properties):
+# Format of snapshots written in delta mode (see classify_features)
+SNAPSHOT_VERSION = 1
 
-    period_id = properties.get("operationalPeriodId", "")
+# Sink files written as GeoJSON text sequences (RFC 8142) get this suffix
+# instead of .geojson, and each feature is a record starting with RS
+GEOJSON_SEQ_SUFFIX = ".geojsons"
+RECORD_SEPARATOR = b"\x1e"
 
-    period = next(
-        (feature for feature in features if feature["id"] == period_id),
-        None
-    )
+_encoder = msgspec.json.Encoder()
 
-    if period:
-        title = period.get("properties", {}).get("title", "").lower()
-        if title == "01 klargjorte oppdrag":
-            return "empty"
-        if title == "02 søkes nå":
-            return "assigned"
-        if title == "03 ferdig søkt":
-            return "searched"
+# Mapping of folders to sink files, mission statuses and point categories
+# are configured in rules.json (see rules.py)
 
-    status = properties.get("status", "").lower()
-    if status == "draft":
-        return "empty"
-    if status == "prepared":
-        return "empty"
-    if status == "inprogress":
-        return "assigned"
-    if status == "completed":
-        return "searched"
 
-    return "empty"
+def index_features(features):
+    """
+    Build lookup tables for the given source features in a single pass.
 
-def derive_point_category(properties):
+    Returns a dict with 'by_id' (feature id to feature), 'folders'
+    (folder id to folder title) and 'periods' (operational period id
+    to period feature). The first feature wins if an id is repeated.
     """
-    Derives the 'category' field based on the given 'marker-symbol'.
+    by_id = {}
+    folders = {}
+    periods = {}
 
-    Args:
-        marker_symbol (str): The marker-symbol property from the source.
+    for feature in features:
+        feature_id = feature.id
+        if feature_id is None:
+            continue
+        if feature_id in by_id:
+            continue
+        by_id[feature_id] = feature
 
-    Returns:
-        str: The resulting category.
-    """
+        feature_class = feature.properties.feature_class
+        if feature_class == sartopo.FOLDER:
+            folders[feature_id] = feature.properties.get_title("None")
+        elif feature_class == sartopo.OPERATIONAL_PERIOD:
+            periods[feature_id] = feature
+
+    return {"by_id": by_id, "folders": folders, "periods": periods}
 
-    title = properties.get("title", "").lower()
-    marker_symbol = properties.get("marker-symbol", "").lower()
+def derive_mission_status(index, properties, ruleset=None):
 
-    if "oppmøte" in title:
-        return "Oppmøtested"
+    if ruleset is None:
+        ruleset = rules.get_rules()
 
-    if "cp" in marker_symbol or "ko" in title or "kommandoplass" in title:
-        return "Kommandoplass"
+    period_id = properties.operational_period_id
 
-    if "bosted" in title or "bopel" in title or "bopæl" in title:
-        return "Bosted"
+    # Periods are usually referenced by OperationalPeriod features, but fall
+    # back to any feature with a matching id to stay compatible
+    period = index["periods"].get(period_id) or index["by_id"].get(period_id)
+    period_title = period.properties.get_title() if period else None
 
-    if "funn" in title:
-        return "Funn av spor"
+    return ruleset.mission_status(period_title, properties.status)
 
-    # Add more conditions or mappings as needed
-    return "Annet"
+def derive_point_category(properties, ruleset=None):
+    """
+    Derives the 'category' field from the title and 'marker-symbol'.
 
-# --- Gjenkjent ---
-# Oppmøtested
-# Kommandoplass
-# Bosted
-# Funn av spor
-# Annet
+    Args:
+        properties (sartopo.Properties): The properties from the source.
+        ruleset (rules.Rules): Classification rules (current rules if not given).
 
-# --- Ikke gjenkjent ---
-# Interesse av hund
-# Hindring
-# Ikke søkbart
-# Mobilspor
-# Observasjon
-# Utkikkspunkt
-# Sperrepost
+    Returns:
+        str: The resulting category.
+    """
+    if ruleset is None:
+        ruleset = rules.get_rules()
+
+    return ruleset.point_category(properties.get_title(), properties.marker_symbol)
 
-def enrich_features(source_data):
+def enrich_features(source_data, index=None, ruleset=None):
     """
     Enrich source features by calculating bounding boxes and adding optional relationships.
+
+    The source data is a sartopo.FeatureCollection. The optional index is
+    the result of index_features() and is built from the source features
+    if not given. The current classification rules are used if ruleset is
+    not given.
     """
     enriched_features = []
     transformed_properties = {}
-    source_features = source_data["features"]
+    source_features = source_data.features
+
+    if index is None:
+        index = index_features(source_features)
+    if ruleset is None:
+        ruleset = rules.get_rules()
 
     for feature in source_features:
         # Extract existing geometry and properties
-        geometry = feature.get("geometry")
-        properties = feature.get("properties", {})
+        geometry = feature.geometry
+        properties = feature.properties
 
         # Skip features with missing or invalid geometry
         if not geometry:
             continue
 
-        feature_type = geometry.get("type", "")
-        feature_class = properties.get("class", "")
-        feature_title = properties.get("title", properties.get("number", ""))
+        feature_id = "" if feature.id is None else feature.id
+        feature_type = sartopo.geometry_type(geometry)
+        feature_class = properties.feature_class
+        feature_title = properties.get_title(properties.number)
 
         # Detect geometry type and add derived information
-        if feature_class == "Assignment":
+        if feature_class == sartopo.ASSIGNMENT:
             if feature_type == "Polygon":
                 transformed_properties = {
-                    "aid": feature.get("id", ""),  # Map the unique id to aid
+                    "aid": feature_id,  # Map the unique id to aid
                     "title": feature_title,  # Use 'title' from source
                     "class": feature_class,
                     "category": "area",
-                    "missionStatus": derive_mission_status(source_features, properties)
+                    "missionStatus": derive_mission_status(index, properties, ruleset)
                 }
 
             if feature_type == "LineString":
                 transformed_properties = {
-                    "aid": feature.get("id", ""),  # Map the unique id to aid
+                    "aid": feature_id,  # Map the unique id to aid
                     "title": feature_title,  # Use 'title' from source
                     "class": feature_class,
                     "category": "path",
-                    "missionStatus": derive_mission_status(source_features, properties)
+                    "missionStatus": derive_mission_status(index, properties, ruleset)
                 }
 
         else:
@@ -150,19 +151,17 @@ def enrich_features(source_data):
             if feature_type == "Point":
                 # Map known fields to the new structure
                 transformed_properties = {
-                    "aid": feature.get("id", ""),  # Map the unique id to aid
-                    "title": properties.get("title", ""),  # Use 'title' from source
+                    "aid": feature_id,  # Map the unique id to aid
+                    "title": properties.get_title(),  # Use 'title' from source
                     "class": feature_class,
                     "level": "Punkt",  # Assign static value
-                    "category": derive_point_category(properties),
-                    "message": properties.get(
-                        "description", properties.get("message", "")
-                    )
+                    "category": derive_point_category(properties, ruleset),
+                    "message": properties.get_message()
                 }
 
             if feature_type == "Polygon":
                 transformed_properties = {
-                    "aid": feature.get("id", ""),  # Map the unique id to aid
+                    "aid": feature_id,  # Map the unique id to aid
                     "title": feature_title,  # Use 'title' from source
                     "class": feature_class,
                     "category": "area",
@@ -171,7 +170,7 @@ def enrich_features(source_data):
 
             if feature_type == "LineString":
                 transformed_properties = {
-                    "aid": feature.get("id", ""),  # Map the unique id to aid
+                    "aid": feature_id,  # Map the unique id to aid
                     "title": feature_title,  # Use 'title' from source
                     "class": feature_class,
                     "category": "path",
@@ -179,12 +178,12 @@ def enrich_features(source_data):
                 }
 
         # Enrich the feature with new properties
-        enriched_features.append(
-            geojson.Feature(
-                geometry=geometry,
-                properties=transformed_properties
-            )
-        )
+        # (coordinates stay raw until the sink files are written)
+        enriched_features.append({
+            "type": "Feature",
+            "geometry": geometry,
+            "properties": transformed_properties
+        })
 
     # Return the enriched data structure
     return {"type": "FeatureCollection", "features": enriched_features}
@@ -202,18 +201,30 @@ def create_sink_files():
         "Statistiske_reflekser.geojson": {"type": "FeatureCollection", "features": []},
     }
 
-def classify_features(source_data, output_folder):
+def sort_features(source_data):
     """
-    Classify features from the source data into appropriate sink files
-    and write the output to the specified output folder.
+    Classify features from the source data into appropriate sink files.
+
+    Returns the sink files (file name to FeatureCollection) without
+    writing them.
     """
-    # Enrich source features before classifying them
-    enriched_data = enrich_features(source_data)
+    # Build lookup tables once and enrich source features before classifying them
+    index = index_features(source_data.features)
+    ruleset = rules.get_rules()
+    return sort_enriched_features(enrich_features(source_data, index, ruleset), ruleset)
 
+def sort_enriched_features(enriched_data, ruleset=None):
+    """
+    Classify features enriched by enrich_features() into sink files (see
+    sort_features). The current classification rules are used if ruleset
+    is not given.
+    """
+    if ruleset is None:
+        ruleset = rules.get_rules()
     sink_files = create_sink_files()
 
     for feature in enriched_data["features"]:
-        feature_type = feature["geometry"].get("type", "")
+        feature_type = sartopo.geometry_type(feature["geometry"])
         feature_class = feature["properties"].get("class", "")
         feature_title = feature["properties"].get("title", "")
         feature_geometry = feature.get("geometry", None)
@@ -221,8 +232,9 @@ def classify_features(source_data, output_folder):
         # Classify based on feature class
         if feature_class == "Folder":
             # Folders themselves aren't geometric; categorize based on folder-to-sink mapping
-            if feature_title in folder_to_sink:
-                sink_files[folder_to_sink[feature_title]]["features"].append(feature)
+            sink_file = ruleset.folder_to_sink.get(feature_title)
+            if sink_file is not None:
+                sink_files[sink_file]["features"].append(feature)
         elif feature_geometry:
             if feature_type == "Point":
                 # All Point features go to Punkter.geojson
@@ -233,35 +245,393 @@ def classify_features(source_data, output_folder):
             elif feature_type == "Polygon":  # Polygon features
                 sink_files["Soeksarealer.geojson"]["features"].append(feature)
 
+    return sink_files
+
+def reduce_sink_files(sink_files, tolerance=None, precision=None):
+    """
+    Simplify and/or quantize the geometries of all features in the sink
+    files in one batch (see spatial.reduce_geometries).
+
+    Args:
+        sink_files (dict): Sink files as returned by sort_features().
+        tolerance (float): Simplification tolerance in meters, or None.
+        precision (int): Number of decimals to keep in coordinates, or None.
+
+    Returns:
+        int: Number of coordinate bytes saved.
+    """
+    import spatial
+
+    features = [feature for content in sink_files.values() for feature in content["features"]]
+    geometries, bytes_before, bytes_after = spatial.reduce_geometries(
+        [feature["geometry"] for feature in features], tolerance, precision
+    )
+    for feature, geometry in zip(features, geometries):
+        feature["geometry"] = geometry
+    return bytes_before - bytes_after
+
+def sink_file_name(sink_file, sequence=False):
+    """
+    Returns the name a sink file is written with.
+    """
+    if sequence:
+        return f"{os.path.splitext(sink_file)[0]}{GEOJSON_SEQ_SUFFIX}"
+    return sink_file
+
+def _encode_feature(feature):
+    # Coordinates are expanded (and rounded) one feature at a time
+    geometry = feature.get("geometry")
+    if isinstance(geometry, msgspec.Struct):
+        feature = {**feature, "geometry": sartopo.to_geojson(geometry)}
+    return _encoder.encode(feature)
+
+def dump_sink_file(content, f, compact=False, sequence=False):
+    """
+    Serialize sink file content to the given binary file object.
+
+    Indented output is written by json, as FAKS imports it. Compact output
+    drops indentation and whitespace between tokens, and is encoded with
+    msgspec one feature at a time. A sequence is a GeoJSON text sequence
+    (RFC 8142) with one compact feature per line instead of a
+    FeatureCollection, so it can be read as a stream.
+    """
+    if sequence:
+        for feature in content["features"]:
+            f.write(RECORD_SEPARATOR + _encode_feature(feature) + b"\n")
+    elif compact:
+        f.write(b'{"type":"FeatureCollection","features":[')
+        for i, feature in enumerate(content["features"]):
+            if i:
+                f.write(b",")
+            f.write(_encode_feature(feature))
+        f.write(b"]}")
+    else:
+        text = io.TextIOWrapper(f, encoding="utf-8")
+        json.dump(content, text, ensure_ascii=False, indent=2, default=sartopo.to_geojson)
+        # Leave the file open for the caller
+        text.detach()
+
+def write_sink_zip(sink_files, file, compress_level=DEFAULT_COMPRESS_LEVEL, compact=False, skip_empty=False,
+                   sequence=False):
+    """
+    Serialize each sink file into its own entry in a zip archive.
+
+    Args:
+        sink_files (dict): Sink files as returned by sort_features().
+        file (str or file object): Path to write the zip archive to, or a
+            writable binary file object (does not need to be seekable).
+        compress_level (int): Deflate level 0-9, or None to store entries uncompressed.
+        compact (bool): Write compact JSON instead of indented JSON.
+        skip_empty (bool): Leave sink files without features out of the archive.
+        sequence (bool): Write GeoJSON text sequences (.geojsons) instead
+            of FeatureCollections.
+
+    Returns:
+        list: Names of the sink files written to the archive.
+    """
+    if compress_level is None:
+        compression = zipfile.ZIP_STORED
+    else:
+        compression = zipfile.ZIP_DEFLATED
+
+    written = []
+    with zipfile.ZipFile(file, "w", compression=compression, compresslevel=compress_level) as zipf:
+        for sink_file, content in sink_files.items():
+            if skip_empty and not content["features"]:
+                continue
+            # Stamp entries with the current time (defaults to 1980 otherwise),
+            # in the local header and the central directory alike
+            name = sink_file_name(sink_file, sequence)
+            zinfo = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+            data = io.BytesIO()
+            dump_sink_file(content, data, compact, sequence)
+            zipf.writestr(zinfo, data.getvalue(), compress_type=compression, compresslevel=compress_level)
+            written.append(name)
+
+    return written
+
+def write_sink_files(sink_files, output_folder, compact=False, skip_empty=False, sequence=False):
+    """
+    Write each sink file to the specified output folder.
+    """
     # Ensure the output folder exists (create it if necessary)
     os.makedirs(output_folder, exist_ok=True)
 
     # Write output to sink files
     for sink_file, content in sink_files.items():
-        file_path = os.path.join(output_folder, sink_file)  # Write each sink file to the output folder
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(content, f, ensure_ascii=False, indent=2)
+        if skip_empty and not content["features"]:
+            continue
+        # Write each sink file to the output folder
+        file_path = os.path.join(output_folder, sink_file_name(sink_file, sequence))
+        with open(file_path, "wb") as f:
+            dump_sink_file(content, f, compact, sequence)
+
+def hash_sink_files(sink_files):
+    """
+    Returns a snapshot of the sink files: for each sink file, the list of
+    [aid, content hash] of its features in order.
+    """
+    encoder = msgspec.json.Encoder()
+    return {
+        sink_file: [
+            [feature["properties"].get("aid", ""),
+             hashlib.blake2b(encoder.encode(feature), digest_size=16).hexdigest()]
+            for feature in content["features"]
+        ]
+        for sink_file, content in sink_files.items()
+    }
+
+def diff_snapshots(previous, current):
+    """
+    Compare the snapshots of two conversions (see hash_sink_files).
+
+    Returns:
+        tuple: (sink files that changed, counts of added, changed and
+        removed features by id). Everything is added if there is no
+        previous snapshot.
+    """
+    previous = previous or {}
+    changed_sinks = [
+        sink_file for sink_file, features in current.items()
+        if previous.get(sink_file) != features
+    ]
+
+    before = {aid: digest for features in previous.values() for aid, digest in features}
+    after = {aid: digest for features in current.values() for aid, digest in features}
+    counts = {
+        "added": sum(1 for aid in after if aid not in before),
+        "changed": sum(1 for aid, digest in after.items() if aid in before and before[aid] != digest),
+        "removed": sum(1 for aid in before if aid not in after),
+    }
+    return changed_sinks, counts
+
+def load_snapshot(snapshot_path):
+    """
+    Read the snapshot written by an earlier conversion (None if there is
+    none, or it is from another version).
+    """
+    try:
+        with open(snapshot_path, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    return snapshot["sinks"]
+
+def save_snapshot(snapshot_path, sinks):
+    snapshot_parent = os.path.dirname(snapshot_path)
+    if snapshot_parent:
+        os.makedirs(snapshot_parent, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=snapshot_parent)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"version": SNAPSHOT_VERSION, "sinks": sinks}, f)
+    os.replace(tmp_path, snapshot_path)
+
+def classify_features(source_data, output_folder, tolerance=None, precision=None, snapshot_path=None,
+                      compact=False, sequence=False):
+    """
+    Classify features from the source data into appropriate sink files
+    and write the output to the specified output folder.
+
+    If the output folder ends with '.zip', the sink files are written
+    directly into a zip archive with that name instead. Geometries are
+    simplified with the given tolerance (meters) and coordinates rounded
+    to the given number of decimals if set. Sink files are written as
+    compact JSON or GeoJSON text sequences if set (see dump_sink_file).
+
+    With a snapshot path (delta mode), features are compared by id and
+    content with the snapshot of the previous conversion, and only sink
+    files that changed are written (a zip archive is written in full when
+    any of them changed). The snapshot is then updated.
+    """
+    sink_files = sort_features(source_data)
+
+    if tolerance or precision is not None:
+        saved = reduce_sink_files(sink_files, tolerance, precision)
+        print(f"Geometry simplification saved {saved} bytes of coordinates in '{output_folder}'")
+
+    if snapshot_path is not None:
+        snapshot = hash_sink_files(sink_files)
+        changed_sinks, counts = diff_snapshots(load_snapshot(snapshot_path), snapshot)
+        print(
+            f"{counts['added']} added, {counts['changed']} changed and {counts['removed']} removed "
+            f"features in {len(changed_sinks)} of {len(sink_files)} sink files"
+        )
+        if not changed_sinks:
+            print(f"No changes since last conversion, nothing written to '{output_folder}'")
+            return
+
+    if output_folder.lower().endswith(".zip"):
+        # The zip archive replaces the previous one, so it gets all sink files
+        output_parent = os.path.dirname(output_folder)
+        if output_parent:
+            os.makedirs(output_parent, exist_ok=True)
+        write_sink_zip(sink_files, output_folder, compact=compact, sequence=sequence)
+    else:
+        if snapshot_path is not None:
+            sink_files = {sink_file: sink_files[sink_file] for sink_file in changed_sinks}
+        write_sink_files(sink_files, output_folder, compact=compact, sequence=sequence)
+
+    # Only update the snapshot when the output is written
+    if snapshot_path is not None:
+        save_snapshot(snapshot_path, snapshot)
 
     print(f"Features successfully classified and written to sink files in '{output_folder}'!")
 
 
+def expand_sources(sources):
+    """
+    Expand source arguments (files, glob patterns or directories) into a
+    sorted list of source files without duplicates.
+    """
+    source_files = []
+    for source in sources:
+        if os.path.isdir(source):
+            # Convert all GeoJSON files found directly in the directory
+            matches = [
+                os.path.join(source, name) for name in os.listdir(source)
+                if name.lower().endswith((".geojson", ".json"))
+            ]
+        elif glob.has_magic(source):
+            matches = glob.glob(source)
+        else:
+            matches = [source]
+        source_files.extend(sorted(f for f in matches if f not in source_files))
+    return source_files
+
+def batch_outputs(source_files, output_root, as_zip=False):
+    """
+    Give each source file its own output folder (or zip) in the output root.
+    """
+    outputs = []
+    used = set()
+    for source_file in source_files:
+        name = os.path.splitext(os.path.basename(source_file))[0]
+        # Avoid collisions between files with the same name in different folders
+        unique_name, n = name, 1
+        while unique_name in used:
+            n += 1
+            unique_name = f"{name}_{n}"
+        used.add(unique_name)
+        outputs.append(os.path.join(output_root, f"{unique_name}.zip" if as_zip else unique_name))
+    return outputs
+
+def convert_file(source_file, output_folder, tolerance=None, precision=None, compact=False, sequence=False):
+    """
+    Convert a single SARTopo export file. Returns the number of source features.
+    """
+    source_data = sartopo.load(source_file)
+    classify_features(source_data, output_folder, tolerance, precision, compact=compact, sequence=sequence)
+    return len(source_data.features)
+
+def convert_batch(source_files, output_root, workers=None, as_zip=False, tolerance=None, precision=None,
+                  compact=False, sequence=False):
+    """
+    Convert many SARTopo export files in parallel worker processes.
+
+    A file that fails to convert is reported and skipped without
+    aborting the batch. Returns the list of failed source files.
+    """
+    outputs = batch_outputs(source_files, output_root, as_zip)
+    failed = []
+    features = 0
+    started = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(convert_file, source_file, output, tolerance, precision, compact, sequence): source_file
+            for source_file, output in zip(source_files, outputs)
+        }
+        for future in as_completed(futures):
+            source_file = futures[future]
+            try:
+                features += future.result()
+            except Exception as e:
+                print(f"Error converting source file '{source_file}': {e}")
+                failed.append(source_file)
+
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    converted = len(source_files) - len(failed)
+    print(
+        f"Converted {converted} of {len(source_files)} files ({features} features) "
+        f"in {elapsed:.2f}s: {converted / elapsed:.2f} files/s, {features / elapsed:.0f} features/s"
+    )
+    return failed
+
+
 if __name__ == "__main__":
-    # Check command-line arguments
-    if len(sys.argv) != 3:
-        print("Usage: python sartopo2faks.py <source_file> <output_folder>")
+    parser = argparse.ArgumentParser(
+        description="Convert SARTopo GeoJSON exports to FAKS GeoJSON import files."
+    )
+    parser.add_argument(
+        "sources", nargs="+", metavar="source",
+        help="source file, glob pattern or directory with source files",
+    )
+    parser.add_argument(
+        "output", help="output folder (or .zip file when converting a single source file)"
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, default=None,
+        help="number of worker processes in batch mode (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--zip", action="store_true",
+        help="write a zip file per source file in batch mode instead of a folder",
+    )
+    parser.add_argument(
+        "--simplify", type=float, default=None, metavar="METERS",
+        help="simplify lines and areas within the given tolerance in meters",
+    )
+    parser.add_argument(
+        "--precision", type=int, default=None, metavar="DECIMALS",
+        help="round coordinates to the given number of decimals",
+    )
+    parser.add_argument(
+        "--compact", action="store_true",
+        help="write compact JSON without indentation",
+    )
+    parser.add_argument(
+        "--seq", action="store_true",
+        help="write GeoJSON text sequences (.geojsons, RFC 8142) with one feature per line "
+             "instead of FeatureCollections (not read by FAKS)",
+    )
+    parser.add_argument(
+        "--delta", default=None, metavar="SNAPSHOT",
+        help="only write sink files that changed since the conversion saved in the snapshot file, "
+             "and update it (single source file only, a .zip output is written in full when "
+             "anything changed)",
+    )
+    args = parser.parse_args()
+
+    source_files = expand_sources(args.sources)
+    if not source_files:
+        print("No source files found")
         sys.exit(1)
 
+    # Batch mode when given more than one file, a pattern or a directory
+    batch = len(args.sources) > 1 or len(source_files) > 1 or source_files[0] != args.sources[0]
+    if batch:
+        if args.delta:
+            parser.error("--delta can only be used when converting a single source file")
+        failed = convert_batch(
+            source_files, args.output, args.workers, args.zip, args.simplify, args.precision,
+            args.compact, args.seq,
+        )
+        sys.exit(1 if failed else 0)
+
     # Get arguments from the command line
-    source_file = sys.argv[1]
-    output_folder = sys.argv[2]
+    source_file = source_files[0]
+    output_folder = args.output
 
     # Load the source GeoJSON data
     try:
-        with open(source_file, "r", encoding="utf-8") as f:
-            source_data = json.load(f)
+        source_data = sartopo.load(source_file)
     except Exception as e:
         print(f"Error reading source file '{source_file}': {e}")
         sys.exit(1)
 
     # Run feature classification
-    classify_features(source_data, output_folder)
\ No newline at end of file
+    classify_features(
+        source_data, output_folder, args.simplify, args.precision, args.delta, args.compact, args.seq
+    )
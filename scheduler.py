@@ -1,142 +1,132 @@
-# Safe file read function
-import fcntl
-import json
+import atexit
 import os
 import shutil
+import socket
+import threading
 from datetime import datetime, timedelta
 
-from apscheduler.schedulers.background import BackgroundScheduler
+import featurecache
+import jobstore
+import resultcache
+import storage
 
-# Scheduler for handling background tasks
-scheduler = BackgroundScheduler()
-scheduler.start()
-
-# File path to store the data
-GENERATED_JOBS_FILE = "generated_jobs.json"
-SCHEDULED_JOBS_FILE = "scheduled_jobs.json"
+# Scheduler for handling background tasks (created and started by
+# init_scheduler, so importing this module starts no threads)
+scheduler = None
 
 DEFAULT_EXPIRATION_TIME = timedelta(minutes=10)
 
-def safe_read(file_path):
-    if not os.path.exists(file_path):
-        return {}
-    with open(file_path, "r") as f:
-        fcntl.flock(f, fcntl.LOCK_SH)
-        try:
-            data = json.load(f)
-        except json.JSONDecodeError:
-            data = {}
-        finally:
-            fcntl.flock(f, fcntl.LOCK_UN)
-    return data
-
-
-# Safe file write function
-def safe_write(file_path, data):
-    with open(file_path, "w") as f:
-        fcntl.flock(f, fcntl.LOCK_EX)
-        try:
-            json.dump(data, f, indent=4)
-        finally:
-            fcntl.flock(f, fcntl.LOCK_UN)
-
-def load_generated_jobs():
-    return safe_read(GENERATED_JOBS_FILE)
-
-def save_generated_jobs(jobs):
-    safe_write(GENERATED_JOBS_FILE, jobs)
+# How often expired jobs are deleted, and how many are deleted per batch
+SWEEP_INTERVAL = timedelta(seconds=15)
+SWEEP_BATCH_SIZE = 100
+SWEEPER_JOB_ID = "expiry_sweeper"
+
+# Every web worker runs the scheduler, but only the worker holding the
+# leader lease does the work. If the leader dies, its lease expires and
+# another worker takes over on its next run.
+LEADER_LEASE = "scheduler"
+LEASE_DURATION = 4 * SWEEP_INTERVAL
+
+_init_lock = threading.Lock()
+
+def load_generated_jobs(limit=None, offset=0, upload_file=None, created_after=None, created_before=None):
+    return jobstore.query_generated_jobs(limit, offset, upload_file, created_after, created_before)
 
 def delete_generated_jobs():
-    safe_write(GENERATED_JOBS_FILE, {})
+    return jobstore.clear_generated_jobs()
 
-def load_scheduled_jobs():
-    return safe_read(SCHEDULED_JOBS_FILE)
+def load_scheduled_jobs(limit=None, offset=0, expires_after=None, expires_before=None):
+    return jobstore.query_scheduled_jobs(limit, offset, expires_after, expires_before)
 
-def save_scheduled_jobs(jobs):
-    safe_write(SCHEDULED_JOBS_FILE, jobs)
+def remove_folder(folder_path):
+    try:
+        shutil.rmtree(folder_path)
+        print(f"Deleted job folder: {folder_path}")
+    except FileNotFoundError:
+        # Already deleted
+        pass
+
+def remove_job_folders(app, job_id):
+    # Locate job folders (in memory or on disk)
+    for upload_path, output_path in storage.get_all_folders(app, job_id):
+        remove_folder(upload_path)
+        featurecache.discard_folder(upload_path)
+        remove_folder(output_path)
+    jobstore.remove_job_storage(job_id)
 
 def delete_job(app, job_id):
-    # Locate job folders
-    upload_path = os.path.join(
-        app.config['UPLOAD_FOLDER'], f"job_{job_id}"
-    )
-    if os.path.exists(upload_path):
-        print(f"Deleted job folder: {upload_path}")
-        shutil.rmtree(upload_path)
-
-    output_path = os.path.join(
-        app.config['OUTPUT_FOLDER'], f"job_{job_id}"
-    )
-    if os.path.exists(output_path):
-        print(f"Deleted job folder: {output_path}")
-        shutil.rmtree(output_path)
-
-    scheduled_jobs = load_scheduled_jobs()
-    scheduled_jobs.pop(job_id)
-    save_scheduled_jobs(scheduled_jobs)
+    remove_job_folders(app, job_id)
+    jobstore.unschedule_job(job_id)
 
 def schedule_job(app, upload_file, job_id, create_time, delete_time):
-    generated_jobs = load_generated_jobs()
-    generated_jobs[job_id] = {
-        'upload_file': upload_file,
-        'create_time': delete_time.isoformat(),
-        'delete_time': delete_time.isoformat(),
-    }
-    save_generated_jobs(generated_jobs)
-
-    scheduled_jobs = load_scheduled_jobs()
-    scheduled_jobs[job_id] = delete_time.isoformat()
-    save_scheduled_jobs(scheduled_jobs)
-    scheduler.add_job(
-        func=delete_job,
-        trigger="date",
-        run_date=delete_time,
-        args=[app,job_id],  # Pass the file name to delete function
-        id=job_id  # Use file name as job ID
-    )
-
-LOCK_FILE_PATH = "/tmp/scheduler.lock"
-
-def init_scheduler(app):
-
-    """Use a file lock to ensure only one instance initializes the scheduler."""
-    lock_file = open(LOCK_FILE_PATH, "w")
+    # The expiry sweeper picks the job up from the job store when it expires
+    jobstore.add_job(job_id, upload_file, create_time, delete_time)
+
+def sweep_expired_jobs(app, now=None):
+    """
+    Delete all jobs that have expired, in batches in order of expiry.
+
+    Returns the number of jobs deleted.
+    """
+    now = now or datetime.now()
+    deleted = 0
+    while True:
+        job_ids = jobstore.get_expired_jobs(now, SWEEP_BATCH_SIZE)
+        for job_id in job_ids:
+            remove_job_folders(app, job_id)
+        jobstore.unschedule_jobs(job_ids)
+        deleted += len(job_ids)
+        if len(job_ids) < SWEEP_BATCH_SIZE:
+            return deleted
+
+def run_maintenance(app):
+    """
+    Run background maintenance if this worker is the leader.
+    """
+    if not jobstore.acquire_lease(LEADER_LEASE, get_lease_holder(), LEASE_DURATION.total_seconds()):
+        return
+    sweep_expired_jobs(app)
+    resultcache.evict()
+    featurecache.evict()
+    storage.evict(app)
+
+def get_lease_holder():
+    # Processes forked after import have their own identity
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def release_leadership():
     try:
-        # Try to acquire an exclusive file lock
-        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        print("Lock acquired: Initializing scheduler...")
-
-        # Load the existing scheduled_jobs from the shared file
-        scheduled_jobs = load_scheduled_jobs()
-
-        # Initialize job deletions
-        for folder in os.listdir(app.config['UPLOAD_FOLDER']):
-            folder_path = os.path.join(app.config['UPLOAD_FOLDER'], folder)
-            if os.path.isdir(folder_path) and folder.startswith("job_"):
-                # Extract the job_id from the folder name by removing the "job_" prefix
-                job_id = folder[4:]  # Extract everything after "job_"
-
-                # Calculate delete time
-                delete_time = datetime.now() + DEFAULT_EXPIRATION_TIME
-
-                # Initialize scheduled_jobs with job_id and folder metadata
-                scheduled_jobs[job_id] = delete_time.isoformat()
-
-                # Schedule job
-                scheduler.add_job(
-                    func=delete_job,
-                    trigger="date",
-                    run_date=delete_time,
-                    args=[app,job_id],  # Pass the file name to delete function
-                    id=job_id  # Use file name as job ID
-                )
-
-        # Save the updated scheduled_jobs to the shared file
-        save_scheduled_jobs(scheduled_jobs)
-
-    except BlockingIOError:
-        print("Another instance has initialized the scheduler. Skipping...")
-    finally:
-        # Lock file remains open to keep the lock active
-        lock_file.close()
+        jobstore.release_lease(LEADER_LEASE, get_lease_holder())
+    except Exception:
+        # Shutting down, the lease will expire anyway
+        pass
 
+def init_scheduler(app):
+    """
+    Start the scheduler in this worker. Safe to call from every worker.
+    """
+    global scheduler
+
+    with _init_lock:
+        if scheduler is not None:
+            return
+
+        from apscheduler.schedulers.background import BackgroundScheduler
+        scheduler = BackgroundScheduler()
+
+        # One periodic job deletes expired jobs (when leader). Expiry times
+        # are kept in the job store, so jobs that expired while the app was
+        # down are deleted on the first run, which happens right away.
+        scheduler.add_job(
+            func=run_maintenance,
+            trigger="interval",
+            seconds=SWEEP_INTERVAL.total_seconds(),
+            args=[app],
+            id=SWEEPER_JOB_ID,
+            next_run_time=datetime.now(),
+            max_instances=1,
+            coalesce=True,
+            replace_existing=True,
+        )
+        scheduler.start()
+        atexit.register(release_leadership)
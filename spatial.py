@@ -0,0 +1,358 @@
+import math
+import threading
+from collections import OrderedDict
+
+import msgspec
+import numpy as np
+import shapely
+
+import sartopo
+
+# Vectorized geometry helpers for decoded SARTopo features. Geometries are
+# converted to shapely in one batch, and bounding boxes are computed for
+# all features at once instead of point by point.
+
+# Number of spatial indexes kept in memory (per process)
+MAX_INDEXES = 8
+
+# Approximate length of one degree of latitude
+METERS_PER_DEGREE = 111_320.0
+
+_lock = threading.Lock()
+_indexes = OrderedDict()
+_geometry_decoder = msgspec.json.Decoder(sartopo.Geometry)
+
+
+def _is_position(position):
+    return (
+        isinstance(position, list) and len(position) >= 2
+        and isinstance(position[0], (int, float)) and isinstance(position[1], (int, float))
+    )
+
+
+def _flatten_positions(coordinates):
+    # Positions ([lng, lat, ...]) in nested coordinates as a flat list
+    if not isinstance(coordinates, list) or not coordinates:
+        return []
+    if not isinstance(coordinates[0], list):
+        return [coordinates] if _is_position(coordinates) else []
+    if not isinstance(coordinates[0][0], list):
+        return [position for position in coordinates if _is_position(position)]
+    positions = []
+    for part in coordinates:
+        positions.extend(_flatten_positions(part))
+    return positions
+
+
+def _member_positions(members):
+    positions = []
+    for member in members if isinstance(members, list) else []:
+        if isinstance(member, dict):
+            if "geometries" in member:
+                positions.extend(_member_positions(member["geometries"]))
+            else:
+                positions.extend(_flatten_positions(member.get("coordinates")))
+    return positions
+
+
+def _positions(geometry):
+    """
+    Returns the positions ([lng, lat, ...]) of a decoded geometry as a flat
+    list, read from its raw coordinates.
+    """
+    if geometry is None:
+        return []
+    if isinstance(geometry, sartopo.GeometryCollection):
+        return _member_positions(msgspec.json.decode(geometry.geometries))
+    return _flatten_positions(msgspec.json.decode(geometry.coordinates))
+
+
+def _trim(coordinates):
+    # Keep at most three values per position (shapely rejects more)
+    if isinstance(coordinates, list) and coordinates and isinstance(coordinates[0], list):
+        return [_trim(part) for part in coordinates]
+    return coordinates[:3] if isinstance(coordinates, list) else coordinates
+
+
+def _trim_member(member):
+    if not isinstance(member, dict):
+        return member
+    if "geometries" in member:
+        return {**member, "geometries": [_trim_member(m) for m in member["geometries"] or []]}
+    return {**member, "coordinates": _trim(member.get("coordinates"))}
+
+
+def _to_document(geometry):
+    if isinstance(geometry, sartopo.GeometryCollection):
+        members = msgspec.json.decode(geometry.geometries)
+        members = members if isinstance(members, list) else []
+        return {"type": "GeometryCollection", "geometries": [_trim_member(member) for member in members]}
+    return {"type": sartopo.geometry_type(geometry), "coordinates": _trim(msgspec.json.decode(geometry.coordinates))}
+
+
+def to_shapely(geometries):
+    """
+    Convert decoded geometries to an array of shapely geometries in one
+    batch. Values after the elevation (like the time of GPS track points)
+    are dropped. Missing (or invalid) geometries become None.
+    """
+    documents = np.array([
+        None if geometry is None else msgspec.json.encode(_to_document(geometry))
+        for geometry in geometries
+    ], dtype=object)
+    return shapely.from_geojson(documents, on_invalid="ignore")
+
+
+def geometry_bounds(geometries):
+    """
+    Returns an (n, 4) array with the bounding box (minLng, minLat, maxLng,
+    maxLat) of each decoded geometry, computed from the first two values
+    of its positions. Rows are NaN for missing geometries.
+    """
+    counts = np.zeros(len(geometries), dtype=np.int64)
+    lng = []
+    lat = []
+    for i, geometry in enumerate(geometries):
+        positions = _positions(geometry)
+        counts[i] = len(positions)
+        lng.extend(position[0] for position in positions)
+        lat.extend(position[1] for position in positions)
+
+    bounds = np.full((len(geometries), 4), np.nan)
+    found = counts > 0
+    if found.any():
+        lng = np.array(lng, dtype=float)
+        lat = np.array(lat, dtype=float)
+        # Positions of each geometry follow each other, reduce them per geometry
+        starts = (np.cumsum(counts) - counts)[found]
+        bounds[found, 0] = np.minimum.reduceat(lng, starts)
+        bounds[found, 1] = np.minimum.reduceat(lat, starts)
+        bounds[found, 2] = np.maximum.reduceat(lng, starts)
+        bounds[found, 3] = np.maximum.reduceat(lat, starts)
+    return bounds
+
+
+def combine_bounds(bounds):
+    """
+    Returns the bounding box (minLng, minLat, maxLng, maxLat) around all
+    the given bounding boxes, or None if none of them are set.
+    """
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+    bounds = bounds[~np.isnan(bounds).any(axis=1)]
+    if len(bounds) == 0:
+        return None
+    return (
+        float(bounds[:, 0].min()), float(bounds[:, 1].min()),
+        float(bounds[:, 2].max()), float(bounds[:, 3].max()),
+    )
+
+
+def sink_bounds(sink_files):
+    """
+    Returns the bounding box of each sink file (None for empty sinks).
+    """
+    sinks = list(sink_files)
+    geometries = []
+    sizes = []
+    for sink_file in sinks:
+        sink_features = sink_files[sink_file]["features"]
+        geometries.extend(feature["geometry"] for feature in sink_features)
+        sizes.append(len(sink_features))
+
+    # Compute bounds for all features in all sinks in one batch
+    bounds = geometry_bounds(geometries)
+    ends = np.cumsum(sizes)
+    return {
+        sink_file: combine_bounds(bounds[end - size:end])
+        for sink_file, size, end in zip(sinks, sizes, ends)
+    }
+
+
+# Shapely type and depth of the lists of positions in the coordinates of
+# the geometry types that are simplified (points are only rounded)
+SIMPLIFIED_TYPES = {
+    "LineString": (shapely.GeometryType.LINESTRING, 1),
+    "MultiLineString": (shapely.GeometryType.MULTILINESTRING, 2),
+    "Polygon": (shapely.GeometryType.POLYGON, 2),
+    "MultiPolygon": (shapely.GeometryType.MULTIPOLYGON, 3),
+}
+
+
+def reduce_geometries(geometries, tolerance=None, precision=None):
+    """
+    Simplify and/or quantize decoded geometries in one batch.
+
+    Geometries are simplified on longitude and latitude, and the vertices
+    kept are taken from the original positions, so extra values like the
+    elevation and time of GPS track points ([lng, lat, ele, time]) are kept.
+
+    Args:
+        geometries (list): Decoded geometries (None is allowed).
+        tolerance (float): Simplification tolerance in meters, or None.
+        precision (int): Number of decimals to round coordinates to, or None.
+
+    Returns:
+        tuple: (geometries, bytes_before, bytes_after) where geometries are
+        the reduced geometries (unchanged if they could not be reduced)
+        and the byte counts are the compact JSON size of the coordinates as
+        written to sink files (rounded to sartopo.DEFAULT_PRECISION).
+    """
+    coordinates = {}
+    for i, geometry in enumerate(geometries):
+        if geometry is None or isinstance(geometry, sartopo.GeometryCollection):
+            continue
+        decoded = msgspec.json.decode(geometry.coordinates)
+        if isinstance(decoded, list) and decoded:
+            coordinates[i] = decoded
+    bytes_before = _output_size(coordinates.values())
+
+    if tolerance and coordinates:
+        by_type = {}
+        for i in coordinates:
+            geometry_type = sartopo.geometry_type(geometries[i])
+            if geometry_type in SIMPLIFIED_TYPES and _is_simplifiable(coordinates[i], geometry_type):
+                by_type.setdefault(geometry_type, []).append(i)
+        for geometry_type, ids in by_type.items():
+            simplified = _simplify(geometry_type, [coordinates[i] for i in ids], tolerance)
+            coordinates.update(zip(ids, simplified))
+
+    if precision is not None:
+        coordinates = {
+            i: sartopo.round_coordinates(value, precision) for i, value in coordinates.items()
+        }
+
+    result = list(geometries)
+    for i, value in coordinates.items():
+        result[i] = type(geometries[i])(coordinates=msgspec.Raw(msgspec.json.encode(value)))
+    return result, bytes_before, _output_size(coordinates.values())
+
+
+def _parts(coordinates, depth):
+    # Lists of positions (lines and rings) in nested coordinates
+    if depth == 1:
+        yield coordinates
+    else:
+        for part in coordinates:
+            yield from _parts(part, depth - 1)
+
+
+def _is_simplifiable(coordinates, geometry_type):
+    _, depth = SIMPLIFIED_TYPES[geometry_type]
+    # Rings are closed, with at least 4 positions
+    min_size = 4 if geometry_type in ("Polygon", "MultiPolygon") else 2
+    try:
+        for part in _parts(coordinates, depth):
+            if len(part) < min_size or not all(_is_position(position) for position in part):
+                return False
+            if min_size == 4 and part[0][:2] != part[-1][:2]:
+                return False
+    except TypeError:
+        return False
+    return True
+
+
+def _flatten(items, depth, positions, offsets):
+    # Flatten nested coordinates into positions and the offsets of each
+    # level (as used by shapely.from_ragged_array)
+    for item in items:
+        if depth == 1:
+            positions.extend(item)
+            offsets[0].append(len(positions))
+        else:
+            _flatten(item, depth - 1, positions, offsets)
+            offsets[depth - 1].append(len(offsets[depth - 2]) - 1)
+
+
+def _simplify(geometry_type, coordinates, tolerance):
+    """
+    Simplify geometries of one type given as nested coordinates, and return
+    their simplified coordinates.
+    """
+    shapely_type, depth = SIMPLIFIED_TYPES[geometry_type]
+    positions = []
+    offsets = [[0] for _ in range(depth)]
+    _flatten(coordinates, depth, positions, offsets)
+
+    # Simplify in a local equirectangular projection (meters) centered on
+    # the latitude of the batch, with the index of each vertex as Z value
+    # (simplification only drops vertices)
+    lng_lat = np.array([position[:2] for position in positions], dtype=float)
+    latitude = math.radians((lng_lat[:, 1].min() + lng_lat[:, 1].max()) / 2)
+    projected = np.column_stack([
+        lng_lat * [METERS_PER_DEGREE * math.cos(latitude), METERS_PER_DEGREE],
+        np.arange(len(positions), dtype=float),
+    ])
+    shapes = shapely.from_ragged_array(
+        shapely_type, projected, tuple(np.array(offset) for offset in offsets)
+    )
+    simplified = shapely.simplify(shapes, tolerance, preserve_topology=True)
+    _, kept, kept_offsets = shapely.to_ragged_array(simplified, include_z=True)
+
+    # Nest the original positions of the vertices kept like the coordinates
+    items = [positions[int(index)] for index in kept[:, 2]]
+    for offset in kept_offsets:
+        items = [items[start:end] for start, end in zip(offset[:-1], offset[1:])]
+    return items
+
+
+def _output_size(coordinates):
+    # Coordinates are rounded when written, so measure them rounded
+    return sum(
+        len(msgspec.json.encode(sartopo.round_coordinates(value))) for value in coordinates
+    )
+
+
+class SpatialIndex:
+    """
+    STRtree over the bounding boxes of features in an upload. Queries are
+    answered by the tree first, and only candidate features are decoded
+    to test for exact intersection.
+    """
+
+    def __init__(self, bounds):
+        bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+        self.ids = np.flatnonzero(~np.isnan(bounds).any(axis=1))
+        boxes = shapely.box(*bounds[self.ids].T) if len(self.ids) else []
+        self.tree = shapely.STRtree(boxes)
+
+    def candidates(self, geometry):
+        """
+        Returns ids of features whose bounding box intersects the geometry.
+        """
+        return self.ids[self.tree.query(geometry, predicate="intersects")]
+
+    def intersecting(self, geometry, load_features):
+        """
+        Returns sorted ids of features intersecting the geometry. The
+        load_features callable returns decoded features for a list of ids.
+        """
+        candidates = np.sort(self.candidates(geometry))
+        if len(candidates) == 0:
+            return []
+        features = load_features(candidates.tolist())
+        geometries = to_shapely([feature.geometry for feature in features])
+        hits = shapely.intersects(geometries, geometry)
+        return candidates[hits].tolist()
+
+
+def get_spatial_index(key, bounds):
+    """
+    Returns a (cached) SpatialIndex for the given key and feature bounds.
+    """
+    with _lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+
+    index = SpatialIndex(bounds)
+    with _lock:
+        _indexes[key] = index
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def discard_spatial_index(key):
+    with _lock:
+        _indexes.pop(key, None)
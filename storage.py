@@ -0,0 +1,224 @@
+import os
+import shutil
+import time
+from datetime import timedelta
+
+import featurecache
+import jobstore
+
+# Storage of job files (the upload and the output of each job). Jobs are
+# kept on disk in UPLOAD_FOLDER and OUTPUT_FOLDER, or when small, in the
+# same folders under MEMORY_STORAGE_FOLDER on a RAM backed file system
+# (tmpfs), which is shared with the conversion worker processes.
+#
+# The backend of each job is recorded in the job store, so files are found
+# without scanning folders. Jobs in memory are limited by a byte budget
+# shared by all web workers, from the sizes recorded in the job store when
+# uploads, zip files and sink files are written. Jobs that have not been
+# used for MEMORY_STORAGE_TTL, or the least recently used jobs when memory
+# is almost full, are moved to disk by the scheduler.
+
+DISK = "disk"
+MEMORY = "memory"
+
+DEFAULT_MEMORY_FOLDER = "/dev/shm/fakspy" if os.path.isdir("/dev/shm") else None
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+DEFAULT_MEMORY_MAX_JOB_SIZE = 16 * 1024 * 1024
+DEFAULT_MEMORY_TTL = timedelta(minutes=5)
+
+# Bytes reserved for a job relative to its upload (the upload, the zip and
+# single sink files extracted from it) until it is converted
+JOB_SIZE_FACTOR = 3
+
+# Jobs are claimed in the job store while moved, so they are not converted
+# meanwhile (see jobqueue.claim_job)
+MOVING = "moving"
+MOVE_DURATION = 60
+
+# Jobs are moved to disk when memory use passes the high mark, until it
+# is below the low mark (share of the budget)
+EVICT_HIGH = 0.9
+EVICT_LOW = 0.75
+
+
+def _memory_folder(app):
+    return app.config.get('MEMORY_STORAGE_FOLDER', DEFAULT_MEMORY_FOLDER)
+
+
+def get_folders(app, job_id, backend=DISK):
+    """
+    Returns the (upload folder, output folder) of a job in the given backend.
+    """
+    unique_folder = f"job_{job_id}"
+    upload_root = app.config['UPLOAD_FOLDER']
+    output_root = app.config['OUTPUT_FOLDER']
+    if backend == MEMORY:
+        memory_folder = _memory_folder(app)
+        upload_root = os.path.join(memory_folder, os.path.basename(os.path.normpath(upload_root)))
+        output_root = os.path.join(memory_folder, os.path.basename(os.path.normpath(output_root)))
+    return os.path.join(upload_root, unique_folder), os.path.join(output_root, unique_folder)
+
+
+def create_job(app, job_id, size_hint=None):
+    """
+    Choose the backend for a new job from the expected size of its upload
+    (None if not known), and create its upload folder.
+
+    Returns the upload folder.
+    """
+    backend = DISK
+    memory_max_job_size = app.config.get('MEMORY_STORAGE_MAX_JOB_SIZE', DEFAULT_MEMORY_MAX_JOB_SIZE)
+    if _memory_folder(app) and size_hint is not None and size_hint <= memory_max_job_size:
+        budget = app.config.get('MEMORY_STORAGE_BUDGET', DEFAULT_MEMORY_BUDGET)
+        if jobstore.add_job_storage(job_id, MEMORY, size_hint * JOB_SIZE_FACTOR, budget):
+            backend = MEMORY
+    if backend == DISK:
+        jobstore.add_job_storage(job_id, DISK, 0)
+
+    upload_folder, _ = get_folders(app, job_id, backend)
+    os.makedirs(upload_folder, exist_ok=True)
+    return upload_folder
+
+
+def update_job_size(app, job_id, upload_path):
+    """
+    Record the size of a job from its saved upload. Jobs in memory with
+    uploads larger than expected (like compressed uploads) are moved to
+    disk.
+
+    Returns the (possibly moved) upload path.
+    """
+    if jobstore.get_job_backend(job_id) != MEMORY:
+        return upload_path
+    upload_size = os.path.getsize(upload_path)
+    if upload_size <= app.config.get('MEMORY_STORAGE_MAX_JOB_SIZE', DEFAULT_MEMORY_MAX_JOB_SIZE):
+        jobstore.update_job_storage(job_id, size=upload_size * JOB_SIZE_FACTOR)
+        return upload_path
+    move_to_disk(app, job_id)
+    upload_folder, _ = get_folders(app, job_id)
+    return os.path.join(upload_folder, os.path.basename(upload_path))
+
+
+def get_job_folders(app, job_id):
+    """
+    Returns the (upload folder, output folder) of a job.
+    """
+    return get_folders(app, job_id, jobstore.get_job_backend(job_id) or DISK)
+
+
+def get_job_files(app, job_id):
+    """
+    Returns a dict with the upload folder, output folder, upload path and
+    zip path of a job, read from the job store.
+
+    Raises FileNotFoundError if there is no such job.
+    """
+    job = jobstore.get_job_files(job_id)
+    if job is not None:
+        upload_file = job['upload_file']
+        backend = job['backend'] or DISK
+    else:
+        # Jobs uploaded before the job store existed have only the upload folder
+        upload_folder, _ = get_folders(app, job_id)
+        try:
+            files = [f for f in os.listdir(upload_folder)
+                     if os.path.isfile(os.path.join(upload_folder, f))]
+        except FileNotFoundError:
+            files = []
+        if not files:
+            raise FileNotFoundError("No files found in the upload folder.")
+        upload_file = files[0]
+        backend = DISK
+
+    upload_folder, output_folder = get_folders(app, job_id, backend)
+    return {
+        'backend': backend,
+        'upload_file': upload_file,
+        'upload_folder': upload_folder,
+        'output_folder': output_folder,
+        'upload_path': os.path.join(upload_folder, upload_file),
+        'zip_path': os.path.join(output_folder, f"{os.path.splitext(upload_file)[0]}.zip"),
+    }
+
+
+def touch_job(job_id):
+    """
+    Mark a job as used (jobs in memory are moved to disk least recently
+    used first).
+    """
+    jobstore.update_job_storage(job_id, accessed=time.time())
+
+
+def _move(source, target):
+    if os.path.exists(source):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.rmtree(target, ignore_errors=True)
+        shutil.move(source, target)
+
+
+def move_to_disk(app, job_id):
+    """
+    Move the files of a job from memory to disk. Jobs claimed by a queued
+    or running conversion are left in memory.
+
+    Returns True if the job was moved.
+    """
+    if not jobstore.claim_job(job_id, MOVING, MOVE_DURATION):
+        return False
+    try:
+        upload_folder, output_folder = get_folders(app, job_id, MEMORY)
+        disk_upload_folder, disk_output_folder = get_folders(app, job_id, DISK)
+        _move(upload_folder, disk_upload_folder)
+        _move(output_folder, disk_output_folder)
+        featurecache.discard_folder(upload_folder)
+        jobstore.update_job_storage(job_id, backend=DISK)
+    finally:
+        jobstore.release_job(job_id, MOVING)
+    return True
+
+
+def add_job_size(job_id, size):
+    """
+    Record bytes written for a job after it was converted (like sink files
+    extracted from its zip).
+    """
+    jobstore.add_job_size(job_id, size)
+
+
+def get_all_folders(app, job_id):
+    """
+    Returns the (upload folder, output folder) of a job in every backend,
+    for deleting the job wherever its files are.
+    """
+    backends = [DISK, MEMORY] if _memory_folder(app) else [DISK]
+    return [get_folders(app, job_id, backend) for backend in backends]
+
+
+def evict(app, now=None):
+    """
+    Move jobs from memory to disk that have not been used for the TTL, and
+    the least recently used jobs while memory use is above the high mark.
+
+    Returns the number of jobs moved.
+    """
+    if not _memory_folder(app):
+        return 0
+    now = now or time.time()
+    ttl = app.config.get('MEMORY_STORAGE_TTL', DEFAULT_MEMORY_TTL).total_seconds()
+    budget = app.config.get('MEMORY_STORAGE_BUDGET', DEFAULT_MEMORY_BUDGET)
+
+    # Sizes are recorded when files are written, no folders are scanned
+    jobs = jobstore.get_storage_jobs(MEMORY)
+    used = sum(job['size'] for job in jobs)
+
+    moved = 0
+    evicting = used > budget * EVICT_HIGH
+    for job in jobs:
+        if evicting and used <= budget * EVICT_LOW:
+            evicting = False
+        if not evicting and now - job['accessed'] < ttl:
+            continue
+        if move_to_disk(app, job['job_id']):
+            used -= job['size']
+            moved += 1
+    return moved
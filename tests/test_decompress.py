@@ -0,0 +1,41 @@
+import gzip
+import io
+import os
+import sys
+
+import pytest
+from werkzeug.exceptions import RequestEntityTooLarge
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def read_body(environ, start_response):
+    body = environ["wsgi.input"].read()
+    start_response("200 OK", [])
+    return [body]
+
+
+def chunked_request(body, **headers):
+    # Chunked request bodies have no Content-Length
+    return {"wsgi.input": io.BytesIO(body), "wsgi.input_terminated": True, **headers}
+
+
+@pytest.mark.parametrize("encoding", [None, "gzip"])
+def test_chunked_body_is_limited_as_received(encoding):
+    from decompress import UploadLimits
+
+    body = os.urandom(4096)
+    if encoding:
+        body = gzip.compress(body)
+    app = UploadLimits(read_body, {"MAX_UPLOAD_SIZE": 1024})
+    environ = chunked_request(body, **({"HTTP_CONTENT_ENCODING": encoding} if encoding else {}))
+    with pytest.raises(RequestEntityTooLarge):
+        app(environ, lambda status, headers: None)
+
+
+def test_chunked_body_within_limit():
+    from decompress import UploadLimits
+
+    app = UploadLimits(read_body, {"MAX_UPLOAD_SIZE": 1024})
+    assert app(chunked_request(b"x" * 1000), lambda status, headers: None) == [b"x" * 1000]
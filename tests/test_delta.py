@@ -0,0 +1,44 @@
+import json
+import os
+import sys
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def export(marker_title):
+    return {"type": "FeatureCollection", "features": [
+        {
+            "type": "Feature",
+            "id": "track",
+            "geometry": {"type": "LineString", "coordinates": [[9.5, 61.0], [9.6, 61.1]]},
+            "properties": {"class": "Shape", "title": "Spor"},
+        },
+        {
+            "type": "Feature",
+            "id": "marker",
+            "geometry": {"type": "Point", "coordinates": [9.55, 61.05]},
+            "properties": {"class": "Marker", "title": marker_title},
+        },
+    ]}
+
+
+def test_delta_rewrites_whole_zip(tmp_path):
+    import sartopo
+    from sartopo2faks import classify_features
+
+    source = tmp_path / "export.geojson"
+    output = str(tmp_path / "faks.zip")
+    snapshot = str(tmp_path / "faks.snapshot.json")
+
+    def convert(marker_title):
+        source.write_text(json.dumps(export(marker_title)), encoding="utf-8")
+        classify_features(sartopo.load(str(source)), output, snapshot_path=snapshot)
+        with zipfile.ZipFile(output) as zipf:
+            return sorted(zipf.namelist())
+
+    first = convert("Funn")
+    # Only the marker changed, the track is still in the zip
+    assert convert("Funn 2") == first
+    assert "Linjer.geojson" in first
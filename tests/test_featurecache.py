@@ -0,0 +1,37 @@
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def write_upload(folder):
+    os.makedirs(folder)
+    upload_path = os.path.join(folder, "export.geojson")
+    with open(upload_path, "w", encoding="utf-8") as f:
+        json.dump({"type": "FeatureCollection", "features": [{
+            "type": "Feature",
+            "id": "marker",
+            "geometry": {"type": "Point", "coordinates": [9.5, 61.0]},
+            "properties": {"class": "Marker", "title": "Funn"},
+        }]}, f)
+    return upload_path
+
+
+def test_evict_sidecars_over_budget(tmp_path):
+    import featurecache
+    import jobstore
+
+    jobstore.configure(tmp_path / "jobs.sqlite3")
+    uploads = [write_upload(tmp_path / "uploads" / f"job_{i}") for i in range(3)]
+    for upload_path in uploads:
+        featurecache.parse_upload(upload_path)
+    # Used again, so the first upload is no longer the least recently used
+    featurecache.discard_folder(os.path.dirname(uploads[0]))
+    featurecache.load_index(uploads[0])
+
+    size = os.path.getsize(featurecache.get_index_path(uploads[0]))
+    assert featurecache.evict(budget=2 * size) == 1
+    assert [os.path.exists(featurecache.get_index_path(path)) for path in uploads] == [True, False, True]
+    assert featurecache.evict(budget=2 * size) == 0
@@ -0,0 +1,60 @@
+import json
+import math
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def track_coordinates(points=200):
+    # GPS track as exported by SARTopo: [lng, lat, elevation, time]
+    return [
+        [round(9.5 + i * 0.0001, 8), round(61.0 + (i % 2) * 0.000001, 8), 500.0 + i, 1_700_000_000_000 + i * 1000]
+        for i in range(points)
+    ]
+
+
+def test_simplify_makes_4d_track_smaller(tmp_path):
+    source = tmp_path / "track.geojson"
+    source.write_text(json.dumps({"type": "FeatureCollection", "features": [{
+        "type": "Feature",
+        "id": "track",
+        "geometry": {"type": "LineString", "coordinates": track_coordinates()},
+        "properties": {"class": "Shape", "title": "Spor"},
+    }]}), encoding="utf-8")
+
+    def convert(output, *options):
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, "sartopo2faks.py"), *options, str(source), str(output)],
+            check=True, capture_output=True,
+        )
+        with open(output / "Linjer.geojson", "r", encoding="utf-8") as f:
+            return json.load(f)["features"][0]["geometry"]["coordinates"]
+
+    original = convert(tmp_path / "original")
+    simplified = convert(tmp_path / "simplified", "--simplify", "5")
+    assert len(simplified) < len(original)
+    # Vertices kept have their elevation and time
+    assert all(len(position) == 4 for position in simplified)
+    assert simplified[0] == original[0] and simplified[-1] == original[-1]
+
+
+def test_bounds_and_intersection_of_4d_track():
+    import msgspec
+    import shapely
+
+    import sartopo
+    import spatial
+
+    track = sartopo.LineString(coordinates=msgspec.Raw(msgspec.json.encode(track_coordinates(11))))
+    point = sartopo.Point(coordinates=msgspec.Raw(b"[10.5, 62.0]"))
+    bounds = spatial.geometry_bounds([track, None, point])
+    assert bounds[0].tolist() == [9.5, 61.0, 9.501, 61.000001]
+    assert all(map(math.isnan, bounds[1]))
+
+    index = spatial.SpatialIndex(bounds)
+    area = shapely.box(9.4995, 60.9995, 9.5005, 61.0005)
+    geometries = [track, None, point]
+    assert index.intersecting(area, lambda ids: [sartopo.Feature(geometry=geometries[i]) for i in ids]) == [0]
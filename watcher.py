@@ -0,0 +1,238 @@
+import argparse
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+import rules
+import sartopo
+from sartopo2faks import classify_features
+
+# Watch folder mode: a long running process converting SARTopo exports as
+# soon as they are saved in a folder, each into its own output folder (or
+# zip) in the output root. Modules and classification rules stay loaded
+# between files, so a conversion starts right away.
+#
+# New files are noticed with inotify on Linux, and by scanning the folder
+# every POLL_INTERVAL seconds elsewhere. Files are converted when they are
+# closed after writing, or when they have not changed for SETTLE_TIME
+# seconds, so partially written files are not read.
+#
+#   python3 watcher.py eksporter/ faks/
+
+logger = logging.getLogger("watcher")
+
+POLL_INTERVAL = 0.25
+SETTLE_TIME = 0.5
+
+EXTENSIONS = (".geojson", ".json")
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """
+    Names of files closed after writing, or moved into a folder, read from
+    inotify. Only available on Linux.
+    """
+
+    def __init__(self, folder):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"Cannot watch '{folder}'")
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for events, and return the names of the
+        files written.
+        """
+        names = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        while readable:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if name:
+                    names.add(os.fsdecode(name))
+        return names
+
+
+def open_inotify(folder):
+    # Fall back to scanning the folder where inotify is not available
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        return Inotify(folder)
+    except (OSError, AttributeError) as e:
+        logger.warning(f"inotify not available, scanning '{folder}' every {POLL_INTERVAL}s: {e}")
+        return None
+
+
+def get_output(source_file, output_root, as_zip=False):
+    name = os.path.splitext(os.path.basename(source_file))[0]
+    return os.path.join(output_root, f"{name}.zip" if as_zip else name)
+
+
+def get_snapshot_path(output):
+    return f"{os.path.splitext(output)[0] if output.endswith('.zip') else output}.snapshot.json"
+
+
+def is_converted(source_file, output):
+    # Converted by an earlier run if the output is newer than the source
+    try:
+        return os.path.getmtime(output) >= os.path.getmtime(source_file)
+    except OSError:
+        return False
+
+
+def convert(source_file, output, tolerance=None, precision=None, delta=False, compact=False, sequence=False):
+    """
+    Convert a source file in the watched folder and log the time spent.
+    """
+    started = time.perf_counter()
+    source_data = sartopo.load(source_file)
+    loaded = time.perf_counter()
+    snapshot_path = get_snapshot_path(output) if delta else None
+    classify_features(source_data, output, tolerance, precision, snapshot_path, compact, sequence)
+    if os.path.isdir(output):
+        # Folders keep their time when files in them are replaced
+        os.utime(output)
+    done = time.perf_counter()
+
+    # Time from the file was last written until its output was ready
+    latency = time.time() - os.path.getmtime(source_file)
+    logger.info(
+        f"Converted '{source_file}' to '{output}': {len(source_data.features)} features "
+        f"in {done - started:.3f}s (load {loaded - started:.3f}s, convert {done - loaded:.3f}s), "
+        f"{latency:.3f}s after it was written"
+    )
+
+
+def watch(folder, output_root, as_zip=False, tolerance=None, precision=None, delta=False,
+          compact=False, sequence=False):
+    """
+    Convert SARTopo exports saved in the folder until interrupted.
+
+    Exports already in the folder are converted at start unless their
+    output is up to date. Files that are written again are converted again.
+    """
+    os.makedirs(output_root, exist_ok=True)
+    inotify = open_inotify(folder)
+    # Load the rules before the first file arrives
+    rules.get_rules()
+
+    # File name to (size, mtime) when it was converted
+    converted = {}
+    for name in os.listdir(folder):
+        source_file = os.path.join(folder, name)
+        if name.lower().endswith(EXTENSIONS) and is_converted(source_file, get_output(source_file, output_root, as_zip)):
+            stat = os.stat(source_file)
+            converted[name] = (stat.st_size, stat.st_mtime_ns)
+
+    logger.info(f"Watching '{folder}' for SARTopo exports, writing to '{output_root}'")
+    written = set()
+    while True:
+        # Find files that are new or changed since they were converted
+        now = time.time()
+        ready = []
+        waiting = 0
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.lower().endswith(EXTENSIONS):
+                    continue
+                stat = entry.stat()
+                key = (stat.st_size, stat.st_mtime_ns)
+                if converted.get(entry.name) == key:
+                    continue
+                if entry.name in written or now - stat.st_mtime >= SETTLE_TIME:
+                    ready.append((stat.st_mtime, entry.name, key))
+                else:
+                    waiting += 1
+
+        if ready:
+            logger.info(f"Backlog: {len(ready)} files ready, {waiting} being written")
+        for _, name, key in sorted(ready):
+            source_file = os.path.join(folder, name)
+            try:
+                convert(
+                    source_file, get_output(source_file, output_root, as_zip),
+                    tolerance, precision, delta, compact, sequence,
+                )
+            except Exception as e:
+                # Not retried until the file is written again
+                logger.error(f"Error converting source file '{source_file}': {e}")
+            converted[name] = key
+
+        # Check again soon while files are being written
+        timeout = SETTLE_TIME / 2 if waiting else POLL_INTERVAL
+        if inotify is None:
+            time.sleep(timeout)
+            written = set()
+        else:
+            written = inotify.wait(None if not waiting else timeout)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert SARTopo GeoJSON exports as soon as they are saved in a folder."
+    )
+    parser.add_argument("folder", help="folder to watch for SARTopo exports")
+    parser.add_argument("output", help="output folder, each export gets its own folder (or zip) in it")
+    parser.add_argument(
+        "--zip", action="store_true",
+        help="write a zip file per source file instead of a folder",
+    )
+    parser.add_argument(
+        "--simplify", type=float, default=None, metavar="METERS",
+        help="simplify lines and areas within the given tolerance in meters",
+    )
+    parser.add_argument(
+        "--precision", type=int, default=None, metavar="DECIMALS",
+        help="round coordinates to the given number of decimals",
+    )
+    parser.add_argument(
+        "--compact", action="store_true",
+        help="write compact JSON without indentation",
+    )
+    parser.add_argument(
+        "--seq", action="store_true",
+        help="write GeoJSON text sequences (.geojsons, RFC 8142) with one feature per line",
+    )
+    parser.add_argument(
+        "--delta", action="store_true",
+        help="only write sink files that changed since the file was converted last "
+             "(snapshots are kept next to the output, zip files are written in full when anything changed)",
+    )
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        parser.error(f"'{args.folder}' is not a folder")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        watch(
+            args.folder, args.output, args.zip, args.simplify, args.precision, args.delta,
+            args.compact, args.seq,
+        )
+    except KeyboardInterrupt:
+        logger.info("Stopped")